@@ -1,3 +1,4 @@
 from simply_nwb.pipeline.enrichments.saccades.drifting_grating.base import DriftingGratingEnrichment
 from simply_nwb.pipeline.enrichments.saccades.drifting_grating.labjack import DriftingGratingLabjackEnrichment
 from simply_nwb.pipeline.enrichments.saccades.drifting_grating.ephys import DriftingGratingEPhysEnrichment
+from simply_nwb.pipeline.enrichments.saccades.drifting_grating.multi_ephys import DriftingGratingMultiEPhysEnrichment
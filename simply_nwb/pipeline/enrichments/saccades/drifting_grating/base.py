@@ -2,9 +2,11 @@ import types
 import warnings
 
 import numpy as np
+import pandas as pd
 
 from simply_nwb.pipeline import Enrichment, NWBValueMapping
 from simply_nwb.pipeline.funcinfo import FuncInfo
+from simply_nwb.pipeline.util.clock import SessionClock
 from simply_nwb.pipeline.util.waves import startstop_of_squarewave
 from simply_nwb.pipeline.value_mapping import EnrichmentReference
 from simply_nwb.transforms import drifting_grating_metadata_read_from_filelist, labjack_concat_files
@@ -49,6 +51,10 @@ class DriftingGratingEnrichment(Enrichment):
         # TODO get the start/stop times of each grating instance, on the same timescale as the video frames
         raise NotImplemented
 
+    def add_clock_mappings(self, clock: SessionClock):
+        # Add any clocks known by the subclass into the session clock
+        pass
+
     def _run(self, pynwb_obj):
         video_windows = self.get_video_startstop()
         grating_windows = self.get_gratings_startstop()
@@ -67,23 +73,27 @@ class DriftingGratingEnrichment(Enrichment):
 
         # TODO handle a small number of mismatches between labjack and driftingGrating blocks?
 
+        # Video frame start times are in labjack samples, persist the mapping for later conversions
+        clock = SessionClock.from_nwb(pynwb_obj)
+        clock.add_mapping("frame", video_windows[:, 0], np.arange(len(video_windows)))
+        self.add_clock_mappings(clock)
+        clock.save(pynwb_obj)
+
         def process_saccade_epochs(saccade_epoch: np.ndarray):
             # saccade_epoch is a (numsaccade, 2) array for the start/stop of each saccade of a particular type
 
-            # Bin each saccade epoch time into indexes into the video windows for which frame section it is within
-            # interpolate the fractional frame within the signal's frame
-            bins_idxs = np.digitize(saccade_epoch[:, 0], range(video_windows.shape[0]))
-            # Convert the frames into absolute timestamps
-            try:
-                epochstart_framewindows = video_windows[bins_idxs]
-            except IndexError as e:
+            if np.any(saccade_epoch[:, 0] > len(video_windows) - 1):
                 self.logger.info(
-                    "Error binning saccades into the video frame windows! Are labjack files missing? This could happen due to a saccade epoch being outside the recorded labjack time!")
-                raise e
+                    "Error converting saccades into the video frame windows! Are labjack files missing? This could happen due to a saccade epoch being outside the recorded labjack time!")
+                raise IndexError(f"Saccade epoch frame '{np.max(saccade_epoch[:, 0])}' is past the last video frame '{len(video_windows) - 1}'!")
+
+            # Convert the (fractional) start frame of each saccade into labjack samples, the same way the clock is used
+            # everywhere else, interpolating between the frames
+            epochstart_samples = clock.convert(saccade_epoch[:, 0], "frame", "labjack_sample")
 
-            # Use the start of the saccade [:, 0] to determine which grating bin it falls within
+            # Use the start of the saccade to determine which grating bin it falls within
             # grating_windows[:, 1] is the end (right edge) of the grating bin
-            epoch_grating_idxs = np.digitize(epochstart_framewindows[:, 0], grating_windows[:, 1])
+            epoch_grating_idxs = np.digitize(epochstart_samples, grating_windows[:, 1])
             if max(epoch_grating_idxs) >= len(grating_windows):
                 warnings.warn(
                     "Warning: Some detected saccades are outside of the driftingGratings! Indexes outside of this will return None!")
@@ -184,6 +194,20 @@ class DriftingGratingEnrichment(Enrichment):
                     "saccade_index": "Index of the saccade, if a list indexes is passed will return a list of info for each element"},
                 "temporal_saccade_info([45, 89]) #Gets info about temporal saccade 45 and 89"
             ),
+            FuncInfo(
+                "nasal_saccade_info_df",
+                "Get information about nasal saccades as a pandas DataFrame, one row per saccade",
+                {
+                    "saccade_index": "Index or list of indexes of the saccades, defaults to all saccades"},
+                "nasal_saccade_info_df() #DataFrame of info about every nasal saccade, NaN for saccades outside of the gratings"
+            ),
+            FuncInfo(
+                "temporal_saccade_info_df",
+                "Get information about temporal saccades as a pandas DataFrame, one row per saccade",
+                {
+                    "saccade_index": "Index or list of indexes of the saccades, defaults to all saccades"},
+                "temporal_saccade_info_df([45, 89]) #DataFrame of info about temporal saccade 45 and 89"
+            ),
         ]
 
     @staticmethod
@@ -201,6 +225,45 @@ class DriftingGratingEnrichment(Enrichment):
         return DriftingGratingEnrichment._saccade_info(pynwb_obj, "temporal", saccade_index,
                                                        DriftingGratingEnrichment.get_name())
 
+    @staticmethod
+    def nasal_saccade_info_df(pynwb_obj, saccade_index=None):
+        return DriftingGratingEnrichment._saccade_info_df(pynwb_obj, "nasal", saccade_index,
+                                                          DriftingGratingEnrichment.get_name())
+
+    @staticmethod
+    def temporal_saccade_info_df(pynwb_obj, saccade_index=None):
+        return DriftingGratingEnrichment._saccade_info_df(pynwb_obj, "temporal", saccade_index,
+                                                          DriftingGratingEnrichment.get_name())
+
+    @staticmethod
+    def _saccade_info_df(pynwb_obj, saccade_name, indexdata, subname) -> pd.DataFrame:
+        # Get the drifting grating info for the given saccades (or all) as a DataFrame indexed by saccade index
+        # reading each key once and gathering all saccades at once
+        if saccade_name not in ["nasal", "temporal"]:
+            raise ValueError(f"Saccadename must be nasal or temporal, got '{saccade_name}'!")
+
+        saccidxs = np.asarray(Enrichment.get_val(subname, f"{saccade_name}_grating_idxs", pynwb_obj)).ravel()
+        saccade_numbers = np.arange(len(saccidxs))
+        if indexdata is not None:
+            saccade_numbers = np.atleast_1d(saccade_numbers[indexdata])
+            saccidxs = saccidxs[saccade_numbers]
+
+        data = {}
+        warned = False
+        for k in DriftingGratingEnrichment.grating_metadata_keys():
+            val = np.asarray(Enrichment.get_val(subname, k, pynwb_obj))
+            valid = (saccidxs >= 0) & (saccidxs < len(val))
+            if not warned and not np.all(valid):
+                warnings.warn("A saccade is outside of driftingGrating! Will return NaN!")
+                warned = True
+            gathered = val[np.where(valid, saccidxs, 0)] if len(val) else np.full(len(saccidxs), np.nan)
+            data[k] = pd.Series(gathered, index=saccade_numbers).where(valid)
+
+        df = pd.DataFrame(data)
+        df.index.name = "saccade_index"
+        df.insert(0, "grating_idx", saccidxs)
+        return df
+
     @staticmethod
     def _saccade_info(pynwb_obj, saccade_name, indexdata, subname):
         # Get the drifting grating info for a given saccade or list of saccades
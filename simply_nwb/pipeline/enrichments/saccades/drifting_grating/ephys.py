@@ -1,12 +1,39 @@
+import functools
 import os
 import types
 import warnings
 
 import numpy as np
-from population_analysis.processors.kilosort import KilosortProcessor
+from scipy.sparse import csr_matrix
 from simply_nwb.pipeline import Enrichment, NWBValueMapping
+from simply_nwb.pipeline.enrichments.saccades.drifting_grating.labjack import DriftingGratingLabjackEnrichment
 from simply_nwb.pipeline.funcinfo import FuncInfo
-from simply_nwb.pipeline.value_mapping import EnrichmentReference
+from simply_nwb.pipeline.util.chunked import chunked_dataio
+from simply_nwb.pipeline.util.clock import SessionClock
+from simply_nwb.pipeline.util.spikes import binned_spike_counts, firing_rates_from_counts, group_spikes_by_unit, peri_event_histogram, peri_event_spikes, units_table_from_spikes
+
+FIRING_RATE_KEYS = [
+    "firing_rate_counts_data",
+    "firing_rate_counts_indices",
+    "firing_rate_counts_indptr",
+    "firing_rate_unit_ids",
+    "firing_rate_bin_info"
+]
+
+
+def labjack_requirements(lj_timestamps_colname, labjack_barcode_channel) -> NWBValueMapping:
+    """
+    Required values for aligning ephys to the labjack, only the channels that are read are required since the
+    DriftingGratingLabjack enrichment stores them either dense or as transitions depending on its transition_storage
+
+    :param lj_timestamps_colname: labjack column with the timestamps
+    :param labjack_barcode_channel: labjack channel with the barcode signal
+    :returns: NWBValueMapping with 'labjack_time' and 'labjack_barcode'
+    """
+    return NWBValueMapping({
+        "labjack_time": [lambda nwb: DriftingGratingLabjackEnrichment.labjack_channel(nwb, lj_timestamps_colname)],
+        "labjack_barcode": [lambda nwb: DriftingGratingLabjackEnrichment.labjack_channel(nwb, labjack_barcode_channel)]
+    })
 
 
 class DriftingGratingEPhysEnrichment(Enrichment):
@@ -31,16 +58,19 @@ class DriftingGratingEPhysEnrichment(Enrichment):
     NEUROPIXELS_SAMPLING_RATE = 30000
     LABJACK_SAMPLING_RATE = 2000
 
-    def __init__(self, np_barcode_fn, np_spike_clusts_fn, np_spike_times_fn, labjack_barcode_channel="y0", lj_timestamps_colname="Time"):
-        super().__init__(NWBValueMapping({
-            "DriftingGratingLabjack": EnrichmentReference("DriftingGratingLabjack")  # Required that the saccades, labjack and driftingGrating are already in file
-        }))
+    def __init__(self, np_barcode_fn, np_spike_clusts_fn, np_spike_times_fn, labjack_barcode_channel="y0", lj_timestamps_colname="Time", chunk_size=1_000_000, firing_rate_bin_size=0.01, write_units_table=False):
+        super().__init__(labjack_requirements(lj_timestamps_colname, labjack_barcode_channel))  # Required that the labjack is already in file
 
         self.lj_timestamps_colname = lj_timestamps_colname
         self.np_barcode_fn = np_barcode_fn
         self.np_spike_clusts_fn = np_spike_clusts_fn
         self.np_spike_times_fn = np_spike_times_fn
         self.labjack_barcode_channel = labjack_barcode_channel
+        self.chunk_size = chunk_size  # Number of spikes to align and write at a time
+        self.firing_rate_bin_size = firing_rate_bin_size  # Bin size in seconds for the binned spike counts, None to skip
+        # The firing rate keys are only saved when binning, so the instance's keys shadow the static ones
+        self.saved_keys = functools.partial(DriftingGratingEPhysEnrichment.ephys_saved_keys, firing_rate_bin_size is not None)
+        self.write_units_table = write_units_table  # Also write the aligned spikes into nwbfile.units for per-unit access
 
         for fn in [np_barcode_fn, np_spike_clusts_fn, np_spike_times_fn]:
             assert os.path.exists(fn)
@@ -52,13 +82,13 @@ class DriftingGratingEPhysEnrichment(Enrichment):
     @property
     def spike_clusts(self):
         if self._spike_clusts is None:
-            self._spike_clusts = np.load(self.np_spike_clusts_fn)
+            self._spike_clusts = np.load(self.np_spike_clusts_fn, mmap_mode="r")
         return self._spike_clusts
 
     @property
     def spike_times(self):
         if self._spike_times is None:
-            self._spike_times = np.load(self.np_spike_times_fn)
+            self._spike_times = np.load(self.np_spike_times_fn, mmap_mode="r")
         return self._spike_times
 
     @property
@@ -78,60 +108,112 @@ class DriftingGratingEPhysEnrichment(Enrichment):
         np_signal = self.extract_barcode_signals(self.np_barcode, DriftingGratingEPhysEnrichment.NEUROPIXELS_SAMPLING_RATE)
         # indices are the idxs of the first value in the 'pulsetrain' of the neuropixels barcode signal
         # vals is the integer values
-        np_barcode_indices, np_barcode_vals = self.decode_barcode_signals(np_signal, DriftingGratingEPhysEnrichment.NEUROPIXELS_SAMPLING_RATE)
+        np_barcode_indices, np_barcode_vals = self._decode_valid_barcodes(np_signal, DriftingGratingEPhysEnrichment.NEUROPIXELS_SAMPLING_RATE, "neuropixels")
 
-        self.logger.info("Extracting, converting and decoding labjack barcode..")
-        lj_barcode = self._get_req_val(f"DriftingGratingLabjack.{self.labjack_barcode_channel}", pynwb_obj)
-        # Need to convert the signal into transition idxs 'states'
-        lj_states = np.where(np.logical_or(np.diff(lj_barcode) > +0.5, np.diff(lj_barcode) < -0.5))[0]
-        lj_signal = self.extract_barcode_signals(lj_states, DriftingGratingEPhysEnrichment.LABJACK_SAMPLING_RATE)
-        lj_barcode_indices, lj_barcode_vals = self.decode_barcode_signals(lj_signal, DriftingGratingEPhysEnrichment.LABJACK_SAMPLING_RATE)
+        lj_barcode_indices, lj_barcode_vals = self.decode_labjack_barcode(pynwb_obj)
 
         # Align the two integers, and grab the common ones (sometimes the recording devices don't start/stop at the same time)
         matched_vals, common_lj, common_np = np.intersect1d(lj_barcode_vals, np_barcode_vals, return_indices=True)
 
-        # Align the spike times with the neuropixels integer values
-        spike_times_in_counter_time = np.interp(self.spike_times, np.array(np_barcode_indices)[common_np], matched_vals)
-        # Take the aligned spike times (in neuropixel integers) to the labjack integers, to the labjack indices
-        spikes_times_in_labjack_indices = np.round(np.interp(spike_times_in_counter_time, matched_vals, np.array(lj_barcode_indices)[common_lj])).astype(int)
-
-        labjack_time = self._get_req_val(f"DriftingGratingLabjack.{self.lj_timestamps_colname}", pynwb_obj)
-        spike_times_in_labjack_time = labjack_time[spikes_times_in_labjack_indices]
-
-        self._save_val("spike_times_in_neuropixels_time", self.spike_times, pynwb_obj)
-        self._save_val("spike_times_in_labjack_time", spike_times_in_labjack_time, pynwb_obj)
-        self._save_val("spike_clusters", self.spike_clusts, pynwb_obj)
-
-        # kilosort processor broken for low-memory machines/not optimized
-        # kp = KilosortProcessor(self.spike_clusts, spike_times_in_labjack_time)
-        # kp.calculate_firingrates(1.0, False)
+        labjack_time = self._get_req_val("labjack_time", pynwb_obj)
+        clock = SessionClock.from_nwb(pynwb_obj)
+        if "labjack_time" not in clock.mappings:
+            clock.add_mapping("labjack_time", np.arange(len(labjack_time)), labjack_time)
+        # Matching barcodes give the neuropixels sample of each labjack sample
+        clock.add_mapping("neuropixels_sample", lj_barcode_indices[common_lj], np_barcode_indices[common_np])
+        clock.save(pynwb_obj)
+
+        def align_chunk(spike_times):
+            return clock.convert(spike_times, "neuropixels_sample", "labjack_time")
+
+        # Spikes are memory mapped, aligned and written chunk by chunk when the NWB is written to keep memory bounded
+        self.logger.info(f"Aligning {len(self.spike_times)} spikes to labjack time in chunks of {self.chunk_size}..")
+        self._save_val("spike_times_in_neuropixels_time", chunked_dataio(self.spike_times, self.chunk_size), pynwb_obj)
+        self._save_val("spike_times_in_labjack_time", chunked_dataio(self.spike_times, self.chunk_size, transform=align_chunk, dtype=np.float64), pynwb_obj)
+        self._save_val("spike_clusters", chunked_dataio(self.spike_clusts, self.chunk_size), pynwb_obj)
+
+        if self.write_units_table:
+            self._write_units_table(align_chunk, pynwb_obj)
+
+        if self.firing_rate_bin_size is not None:
+            self.logger.info(f"Binning spikes into {self.firing_rate_bin_size}s bins..")
+            counts, unit_ids = binned_spike_counts(self.spike_times, self.spike_clusts, self.firing_rate_bin_size, start=labjack_time[0], stop=labjack_time[-1], chunk_size=self.chunk_size, transform=align_chunk)
+            # Stored as the components of a scipy.sparse.csr_matrix (units, bins)
+            self._save_val("firing_rate_counts_data", counts.data, pynwb_obj)
+            self._save_val("firing_rate_counts_indices", counts.indices, pynwb_obj)
+            self._save_val("firing_rate_counts_indptr", counts.indptr, pynwb_obj)
+            self._save_val("firing_rate_unit_ids", unit_ids, pynwb_obj)
+            self._save_val("firing_rate_bin_info", [labjack_time[0], self.firing_rate_bin_size, counts.shape[1]], pynwb_obj)
 
         # Things that might be interesting?
         # Get spikes for a given unit optional labjack idx time window
-        # Get unit spikes around saccade (trials, unitnum, t) allow multiple input
-        # Get trial times for a saccade in labjack idxs (trials,)
         # Normalize firing rate?
         tw = 2
         pass
 
+    def decode_labjack_barcode(self, pynwb_obj):
+        """
+        Decode the labjack barcode channel
+
+        :param pynwb_obj: NWB with the DriftingGratingLabjack enrichment
+        :returns: (barcodeIndices, barcodeValues) labjack sample index and value of every well formed barcode
+        """
+        self.logger.info("Extracting, converting and decoding labjack barcode..")
+        lj_barcode = self._get_req_val("labjack_barcode", pynwb_obj)
+        # Need to convert the signal into transition idxs 'states'
+        lj_states = np.where(np.logical_or(np.diff(lj_barcode) > +0.5, np.diff(lj_barcode) < -0.5))[0]
+        lj_signal = self.extract_barcode_signals(lj_states, DriftingGratingEPhysEnrichment.LABJACK_SAMPLING_RATE)
+        return self._decode_valid_barcodes(lj_signal, DriftingGratingEPhysEnrichment.LABJACK_SAMPLING_RATE, "labjack")
+
+    def _write_units_table(self, align_chunk, pynwb_obj):
+        if pynwb_obj.units is not None:
+            warnings.warn("NWB already has a units table, not writing the aligned spikes into it!")
+            return
+
+        self.logger.info("Writing aligned spikes into the units table..")
+        # Spikes are read from the memmap unit by unit and aligned chunk by chunk when the NWB is written
+        pynwb_obj.units = units_table_from_spikes(
+            self.spike_times,
+            self.spike_clusts,
+            description="Kilosort units with spike times in labjack time",
+            transform=align_chunk,
+            chunk_size=self.chunk_size
+        )
+
     @staticmethod
     def get_name() -> str:
         return "DriftingGratingEPhys"
 
     @staticmethod
-    def saved_keys() -> list[str]:
-        return [
+    def ephys_saved_keys(firing_rates: bool) -> list[str]:
+        """
+        Keys saved when aligning, the firing rate keys are only saved if firing_rates is True
+        """
+        keys = [
             "spike_times_in_labjack_time",
             "spike_times_in_neuropixels_time",
             "spike_clusters"
         ]
+        if firing_rates:
+            keys.extend(FIRING_RATE_KEYS)
+        return keys
+
+    @staticmethod
+    def saved_keys() -> list[str]:
+        # Without an instance it isn't known if the spikes were binned, only the spike keys are always saved
+        return DriftingGratingEPhysEnrichment.ephys_saved_keys(False)
 
     @staticmethod
     def descriptions() -> dict[str, str]:
         return {
             "spike_times_in_labjack_time": "Kilosort spike times in terms of labjack time",
             "spike_times_in_neuropixels_time": "Original Kilosort (not aligned) spike times in neuropixels time",
-            "spike_clusters": "Unit ID associated with the spike times"
+            "spike_clusters": "Unit ID associated with the spike times",
+            "firing_rate_counts_data": "Data of the scipy.sparse.csr_matrix (units, bins) of binned spike counts, use the firing_rates func to load",
+            "firing_rate_counts_indices": "Indices of the scipy.sparse.csr_matrix (units, bins) of binned spike counts",
+            "firing_rate_counts_indptr": "Indptr of the scipy.sparse.csr_matrix (units, bins) of binned spike counts",
+            "firing_rate_unit_ids": "Unit ID of each row of the binned spike counts",
+            "firing_rate_bin_info": "[start, bin_size, num_bins] of the binned spike counts, start is in labjack time and bin_size in seconds"
         }
 
     @staticmethod
@@ -148,114 +230,262 @@ class DriftingGratingEPhysEnrichment(Enrichment):
             #     },
             #     "test(['myarg'], {'mykwarg': 8})"
             # )
+            FuncInfo(
+                "binned_spike_counts",
+                "Get the binned spike counts of every unit as a sparse matrix",
+                {},
+                "counts, unit_ids = binned_spike_counts() # scipy.sparse.csr_matrix (units, bins), unit id of each row"
+            ),
+            FuncInfo(
+                "firing_rates",
+                "Get the firing rates (spikes/second) of units over the whole session, optionally smoothed",
+                {
+                    "unit_ids": "List of unit ids to get the firing rates of, defaults to all units",
+                    "sigma": "Standard deviation in seconds of the gaussian smoothing, defaults to None (no smoothing)"
+                },
+                "firing_rates([3, 17], sigma=0.02) # (2, bins) smoothed firing rates"
+            ),
+            FuncInfo(
+                "saccade_times",
+                "Get the start time of each saccade in labjack time",
+                {
+                    "saccade_type": "'nasal' or 'temporal'"
+                },
+                "saccade_times('nasal') # Labjack time of each nasal saccade (trials,)"
+            ),
+            FuncInfo(
+                "peri_saccade_rasters",
+                "Get the spikes of each unit around each saccade, as a raster of (trial indexes, spike times relative to saccade start)",
+                {
+                    "unit_ids": "List of unit ids to get the rasters of",
+                    "saccade_type": "'nasal' or 'temporal'",
+                    "windows": "List of (start, stop) windows in seconds relative to the saccade start, defaults to [(-0.5, 0.5)]"
+                },
+                "peri_saccade_rasters([3, 17], 'nasal', [(-0.5, 0.5), (0, 0.2)])[(3, (0, 0.2))] # (trial_idxs, relative_times) of unit 3"
+            ),
+            FuncInfo(
+                "peri_saccade_psth",
+                "Get the binned spikes of each unit around each saccade as a (trials, units, time) array for each window",
+                {
+                    "unit_ids": "List of unit ids to get the PSTH of, in the order of the 'units' axis",
+                    "saccade_type": "'nasal' or 'temporal'",
+                    "windows": "List of (start, stop) windows in seconds relative to the saccade start, defaults to [(-0.5, 0.5)]",
+                    "bin_size": "Width of each time bin in seconds, defaults to 0.01",
+                    "as_rate": "If True return firing rates (spikes/second) instead of counts, defaults to False"
+                },
+                "peri_saccade_psth([3, 17], 'temporal', [(-1, 1)], bin_size=0.05)[(-1, 1)] # (trials, 2, 40) spike counts"
+            )
         ]
 
+    @staticmethod
+    def binned_spike_counts(pynwb_obj):
+        name = DriftingGratingEPhysEnrichment.get_name()
+        start, bin_size, num_bins = Enrichment.get_val(name, "firing_rate_bin_info", pynwb_obj)
+        unit_ids = Enrichment.get_val(name, "firing_rate_unit_ids", pynwb_obj)
+        counts = csr_matrix((
+            Enrichment.get_val(name, "firing_rate_counts_data", pynwb_obj),
+            Enrichment.get_val(name, "firing_rate_counts_indices", pynwb_obj),
+            Enrichment.get_val(name, "firing_rate_counts_indptr", pynwb_obj)
+        ), shape=(len(unit_ids), int(num_bins)))
+        return counts, unit_ids
+
+    @staticmethod
+    def firing_rates(pynwb_obj, unit_ids=None, sigma=None):
+        counts, all_units = DriftingGratingEPhysEnrichment.binned_spike_counts(pynwb_obj)
+        bin_size = Enrichment.get_val(DriftingGratingEPhysEnrichment.get_name(), "firing_rate_bin_info", pynwb_obj)[1]
+
+        rows = None
+        if unit_ids is not None:
+            rows = np.searchsorted(all_units, unit_ids)
+            missing = [u for u, r in zip(unit_ids, rows) if r >= len(all_units) or all_units[r] != u]
+            if missing:
+                raise ValueError(f"Units '{missing}' not found in the binned spike counts!")
+        return firing_rates_from_counts(counts, bin_size, rows=rows, sigma=sigma)
+
+    @staticmethod
+    def saccade_times(pynwb_obj, saccade_type="nasal"):
+        if saccade_type not in ["nasal", "temporal"]:
+            raise ValueError(f"Saccade type must be nasal or temporal, got '{saccade_type}'!")
+
+        # Saccade epochs are in (fractional) video frames
+        epochs = Enrichment.get_val("PredictSaccades", f"saccades_predicted_{saccade_type}_epochs", pynwb_obj)
+        return SessionClock.from_nwb(pynwb_obj).convert(epochs[:, 0], "frame", "labjack_time")
+
+    @staticmethod
+    def _unit_spike_times(pynwb_obj, unit_ids):
+        # Sorted spike times (in labjack time) for each of the given units
+        name = DriftingGratingEPhysEnrichment.get_name()
+        spike_times = np.asarray(Enrichment.get_val(name, "spike_times_in_labjack_time", pynwb_obj)).ravel()
+        spike_clusters = Enrichment.get_val(name, "spike_clusters", pynwb_obj)
+        all_units, order, offsets = group_spikes_by_unit(spike_clusters)
+
+        unit_positions = np.searchsorted(all_units, unit_ids)
+        unit_times = {}
+        for unit_id, pos in zip(unit_ids, unit_positions):
+            if pos >= len(all_units) or all_units[pos] != unit_id:
+                raise ValueError(f"Unit '{unit_id}' not found in spike clusters!")
+            unit_times[unit_id] = np.sort(spike_times[order[offsets[pos]:offsets[pos + 1]]])
+        return unit_times
+
+    @staticmethod
+    def peri_saccade_rasters(pynwb_obj, unit_ids, saccade_type="nasal", windows=((-0.5, 0.5),)):
+        events = DriftingGratingEPhysEnrichment.saccade_times(pynwb_obj, saccade_type)
+        unit_times = DriftingGratingEPhysEnrichment._unit_spike_times(pynwb_obj, unit_ids)
+
+        rasters = {}
+        for unit_id, times in unit_times.items():
+            for window in windows:
+                rasters[(unit_id, tuple(window))] = peri_event_spikes(times, events, window)
+        return rasters
+
+    @staticmethod
+    def peri_saccade_psth(pynwb_obj, unit_ids, saccade_type="nasal", windows=((-0.5, 0.5),), bin_size=0.01, as_rate=False):
+        events = DriftingGratingEPhysEnrichment.saccade_times(pynwb_obj, saccade_type)
+        unit_times = DriftingGratingEPhysEnrichment._unit_spike_times(pynwb_obj, unit_ids)
+
+        psths = {}
+        for window in windows:
+            # (trials, units, t)
+            psth = np.stack([peri_event_histogram(unit_times[unit_id], events, window, bin_size) for unit_id in unit_ids], axis=1)
+            if as_rate:
+                psth = psth / bin_size
+            psths[tuple(window)] = psth
+        return psths
+
     # Code adapted from: https://github.com/jbhunt/myphdlib/blob/668e138548d6344a7a0c9b4873f4ab7491013f0d/myphdlib/pipeline/events.py#L104
-    def extract_barcode_signals(self, stateTransitionIndices, samplingRate, maximumWrapperPulseDuration=0.011, minimumBarcodeInterval=3, pad=100):
+    def extract_barcode_signals(self, stateTransitionIndices, samplingRate, maximumWrapperPulseDuration=0.011, minimumBarcodeInterval=3):
+        """
+        Split the state transitions into barcode pulse trains, dropping incomplete trains
+
+        :param stateTransitionIndices: sorted sample indices of every state transition in the barcode signal
+        :param samplingRate: sampling rate of the signal
+        :param maximumWrapperPulseDuration: max duration (seconds) of the first and last wrapper pulses of a train
+        :param minimumBarcodeInterval: min time (seconds) between pulse trains
+        :returns: (pulseTrainIndices, pulseTrainOffsets) ragged representation of the trains, train i is
+            pulseTrainIndices[pulseTrainOffsets[i]:pulseTrainOffsets[i + 1]]
+        """
         self.logger.info('Extracting barcode signals')
+        transitions = np.asarray(stateTransitionIndices).ravel()
+
+        # Parse individual barcode pulse trains, as [start, end) index ranges into the transitions
+        longIntervalIndices = np.where(np.diff(transitions) >= minimumBarcodeInterval * samplingRate)[0]
+        starts = np.concatenate([[0], longIntervalIndices + 1])
+        ends = np.concatenate([longIntervalIndices + 1, [transitions.size]])
 
-        # Parse individual barcode pulse trains
-        longIntervalIndices = np.where(np.diff(stateTransitionIndices) >= minimumBarcodeInterval * samplingRate)[0]
-        pulseTrains = np.split(stateTransitionIndices, longIntervalIndices + 1)
+        # Need at least 1 pulse on each side for the wrapper
+        complete = (ends - starts) >= 4
+        starts = starts[complete]
+        ends = ends[complete]
 
-        # Filter out incomplete pulse trains
+        # Wrapper pulses should be smaller than the encoding pulses
         pulseDurationThreshold = round(maximumWrapperPulseDuration * samplingRate)
-        pulseTrainsFiltered = list()
-        for pulseTrain in pulseTrains:
-
-            # Need at least 1 pulse on each side for the wrapper
-            if pulseTrain.size < 4:
-                continue
-
-            # Wrapper pulses should be smaller than the encoding pulses
-            firstPulseDuration = pulseTrain[1] - pulseTrain[0]
-            finalPulseDuration = pulseTrain[-1] - pulseTrain[-2]
-            if firstPulseDuration > pulseDurationThreshold:
-                continue
-            elif finalPulseDuration > pulseDurationThreshold:
-                continue
-
-            # Complete pulses
-            pulseTrainsFiltered.append(pulseTrain)
-
-        padded = list()
-        for pulseTrainFiltered in pulseTrainsFiltered:
-            row = list()
-            for index in pulseTrainFiltered:
-                row.append(index)
-            nRight = pad - len(row)
-            for value in np.full(nRight, np.nan):
-                row.append(value)
-                padded.append(row)
-        padded = np.array(padded)
-        return padded
+        firstPulseDurations = transitions[starts + 1] - transitions[starts]
+        finalPulseDurations = transitions[ends - 1] - transitions[ends - 2]
+        wrapped = (firstPulseDurations <= pulseDurationThreshold) & (finalPulseDurations <= pulseDurationThreshold)
+        starts = starts[wrapped]
+        ends = ends[wrapped]
 
-    # Code adapted from: https://github.com/jbhunt/myphdlib/blob/668e138548d6344a7a0c9b4873f4ab7491013f0d/myphdlib/pipeline/events.py#L197
-    def decode_barcode_signals(self, pulseTrainsPadded, samplingRate, barcodeBitSize=0.03, wrapperBitSize=0.01):
-        self.logger.info('Decoding barcode signals')
+        # Gather the kept trains into one flat array
+        lengths = ends - starts
+        pulseTrainOffsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        gatherIndices = np.repeat(starts - pulseTrainOffsets[:-1], lengths) + np.arange(pulseTrainOffsets[-1])
+        pulseTrainIndices = transitions[gatherIndices]
 
-        if pulseTrainsPadded.size == 0:
-            raise ValueError("Invalid pulseTrainPadded passed as arg! Len is 0!")
+        return pulseTrainIndices, pulseTrainOffsets
 
-        pulseTrains = [
-            row[np.invert(np.isnan(row))].astype(np.int32).tolist()
-            for row in pulseTrainsPadded
-        ]
+    # Code adapted from: https://github.com/jbhunt/myphdlib/blob/668e138548d6344a7a0c9b4873f4ab7491013f0d/myphdlib/pipeline/events.py#L197
+    def decode_barcode_signals(self, pulseTrainSignals, samplingRate, barcodeBitSize=0.03, wrapperBitSize=0.01, barcodeBitCount=32):
+        """
+        Decode every barcode pulse train at once into its integer value
+
+        :param pulseTrainSignals: (pulseTrainIndices, pulseTrainOffsets) from extract_barcode_signals
+        :param samplingRate: sampling rate of the signal
+        :param barcodeBitSize: duration (seconds) of a single bit
+        :param wrapperBitSize: duration (seconds) of the wrapper pulses
+        :param barcodeBitCount: number of bits encoded in each barcode
+        :returns: (barcodeIndices, barcodeValues, malformedMask) arrays with an entry for each pulse train. barcodeIndices
+            is the index of the first transition of the train, malformedMask is True for trains that didn't decode to
+            barcodeBitCount bits, their value is -1
+        """
+        self.logger.info('Decoding barcode signals')
 
-        barcodeValues, barcodeIndices = list(), list()
-
-        offset = 0
-        for pulseTrain in pulseTrains:
-
-            wrapperFallingEdge = pulseTrain[1]
-            wrapperRisingEdge = pulseTrain[-2]
-            barcodeLeftEdge = wrapperFallingEdge + round(wrapperBitSize * samplingRate)
-            barcodeRightEdge = wrapperRisingEdge - round(wrapperBitSize * samplingRate)
-
-            # Determine the state at the beginning and end of the data window
-            firstStateTransition = pulseTrain[2]
-            if (firstStateTransition - barcodeLeftEdge) / samplingRate < 0.001:
-                initialSignalState = currentSignalState = True
-            else:
-                initialSignalState = currentSignalState = False
-            finalStateTransition = pulseTrain[-3]
-            if (barcodeRightEdge - finalStateTransition) / samplingRate < 0.001:
-                finalSignalState = True
-            else:
-                finalSignalState = False
-
-            # Determine what indices to use for computing time intervals between state transitions
-            if initialSignalState == True and finalSignalState == True:
-                iterable = pulseTrain[2: -2]
-            elif initialSignalState == True and finalSignalState == False:
-                iterable = np.concatenate([pulseTrain[2:-2], np.array([barcodeRightEdge])])
-            elif initialSignalState == False and finalSignalState == False:
-                iterable = np.concatenate(
-                    [np.array([barcodeLeftEdge]), pulseTrain[2:-2], np.array([barcodeRightEdge])])
-            elif initialSignalState == False and finalSignalState == True:
-                iterable = np.concatenate([np.array([barcodeLeftEdge]), pulseTrain[2:-2]])
-
-            # Determine how many bits are stored in each time interval and keep track of the signal state
-            bitList = list()
-            for nSamples in np.diff(iterable):
-                nBits = int(round(nSamples / (barcodeBitSize * samplingRate)))
-                for iBit in range(nBits):
-                    bitList.append(1 if currentSignalState else 0)
-                currentSignalState = not currentSignalState
-
-            # Decode the strings of bits
-            bitString = ''.join(map(str, bitList[::-1]))
-            if len(bitString) != 32:
-                raise Exception(f'More or less that 32 bits decoded')
-            value = int(bitString, 2) + offset
-
-            # 32-bit integer overflow
-            if value == 2 ** 32 - 1:
-                offset = 2 ** 32
-
-            #
-            barcodeValues.append(value)
-            barcodeIndices.append(pulseTrain[0])
-
-
-        return barcodeIndices, barcodeValues
+        pulseTrainIndices, pulseTrainOffsets = pulseTrainSignals
+        pulseTrainIndices = np.asarray(pulseTrainIndices).astype(np.int64)
+        pulseTrainOffsets = np.asarray(pulseTrainOffsets)
+        if len(pulseTrainOffsets) < 2:
+            raise ValueError("Invalid pulseTrainSignals passed as arg! No pulse trains found!")
+
+        trainStarts = pulseTrainOffsets[:-1]
+        trainEnds = pulseTrainOffsets[1:]
+        numTrains = trainStarts.size
+        trainIds = np.arange(numTrains)
+
+        wrapperSamples = round(wrapperBitSize * samplingRate)
+        barcodeLeftEdges = pulseTrainIndices[trainStarts + 1] + wrapperSamples  # Wrapper falling edge + wrapper size
+        barcodeRightEdges = pulseTrainIndices[trainEnds - 2] - wrapperSamples  # Wrapper rising edge - wrapper size
+
+        # Determine the state at the beginning and end of the data window
+        initialSignalStates = (pulseTrainIndices[trainStarts + 2] - barcodeLeftEdges) / samplingRate < 0.001
+        finalSignalStates = (barcodeRightEdges - pulseTrainIndices[trainEnds - 3]) / samplingRate < 0.001
+
+        # Each train's edges to compute the time intervals from are [leftEdge, train[2:-2]..., rightEdge] where the
+        # left/right edge is only used if the signal is low at the beginning/end of the barcode
+        innerLengths = np.maximum(trainEnds - trainStarts - 4, 0)
+        edgeOffsets = np.concatenate([[0], np.cumsum(innerLengths + 2)])
+        edges = np.empty(edgeOffsets[-1], dtype=np.int64)
+        includeEdges = np.ones(edgeOffsets[-1], dtype=bool)
+        edges[edgeOffsets[:-1]] = barcodeLeftEdges
+        edges[edgeOffsets[1:] - 1] = barcodeRightEdges
+        includeEdges[edgeOffsets[:-1]] = np.invert(initialSignalStates)
+        includeEdges[edgeOffsets[1:] - 1] = np.invert(finalSignalStates)
+        innerLocal = np.arange(innerLengths.sum()) - np.repeat(np.cumsum(innerLengths) - innerLengths, innerLengths)
+        innerPositions = np.repeat(edgeOffsets[:-1] + 1, innerLengths) + innerLocal
+        innerSources = np.repeat(trainStarts + 2, innerLengths) + innerLocal
+        edges[innerPositions] = pulseTrainIndices[innerSources]
+
+        edgeTrainIds = np.repeat(trainIds, innerLengths + 2)[includeEdges]
+        edges = edges[includeEdges]
+
+        # Time intervals between consecutive edges of the same train, and how many bits are stored in each
+        sameTrain = edgeTrainIds[:-1] == edgeTrainIds[1:]
+        intervals = np.diff(edges)[sameTrain]
+        intervalTrainIds = edgeTrainIds[:-1][sameTrain]
+        intervalBitCounts = np.rint(intervals / (barcodeBitSize * samplingRate)).astype(np.int64)
+
+        # Signal state flips with every interval, starting from the initial state of the train
+        intervalsPerTrain = np.bincount(intervalTrainIds, minlength=numTrains)
+        firstInterval = np.cumsum(intervalsPerTrain) - intervalsPerTrain
+        intervalPositions = np.arange(intervalTrainIds.size) - firstInterval[intervalTrainIds]
+        intervalStates = initialSignalStates[intervalTrainIds] ^ (intervalPositions % 2 == 1)
+
+        bitsPerTrain = np.bincount(intervalTrainIds, weights=intervalBitCounts, minlength=numTrains).astype(np.int64)
+        malformedMask = bitsPerTrain != barcodeBitCount
+
+        # Expand the intervals into bits (in time order) for the well formed trains, the first bit is the least significant
+        wellFormedIntervals = np.invert(malformedMask[intervalTrainIds])
+        bits = np.repeat(intervalStates[wellFormedIntervals], intervalBitCounts[wellFormedIntervals])
+        bits = bits.reshape(-1, barcodeBitCount).astype(np.int64)
+        rawValues = bits @ (2 ** np.arange(barcodeBitCount, dtype=np.int64))
+
+        barcodeValues = np.full(numTrains, -1, dtype=np.int64)
+        barcodeValues[np.invert(malformedMask)] = rawValues
+
+        # 32-bit integer overflow, every barcode after the max value gets offset
+        overflowed = barcodeValues == 2 ** barcodeBitCount - 1
+        offsets = (np.cumsum(overflowed) - overflowed) > 0
+        barcodeValues[offsets & np.invert(malformedMask)] += 2 ** barcodeBitCount
+
+        barcodeIndices = pulseTrainIndices[trainStarts]
+        return barcodeIndices, barcodeValues, malformedMask
+
+    def _decode_valid_barcodes(self, pulseTrainSignals, samplingRate, signalName):
+        # Decode the barcodes, dropping (and warning about) the malformed ones
+        barcodeIndices, barcodeValues, malformedMask = self.decode_barcode_signals(pulseTrainSignals, samplingRate)
+        numMalformed = np.count_nonzero(malformedMask)
+        if numMalformed == len(malformedMask):
+            raise ValueError(f"All '{numMalformed}' {signalName} barcodes are malformed! Could not decode any barcodes")
+        if numMalformed > 0:
+            warnings.warn(f"Skipping '{numMalformed}' malformed {signalName} barcodes that did not decode to 32 bits")
+
+        wellFormed = np.invert(malformedMask)
+        return barcodeIndices[wellFormed], barcodeValues[wellFormed]
@@ -7,7 +7,8 @@ from simply_nwb.pipeline import Enrichment, NWBValueMapping
 from simply_nwb.pipeline.enrichments.saccades.drifting_grating.base import DriftingGratingEnrichment
 from simply_nwb.pipeline.funcinfo import FuncInfo
 from simply_nwb.pipeline.util import SkippedListDict
-from simply_nwb.pipeline.util.waves import startstop_of_squarewave
+from simply_nwb.pipeline.util.clock import SessionClock
+from simply_nwb.pipeline.util.waves import signal_from_transitions, signal_transitions, startstop_of_squarewave
 from simply_nwb.pipeline.value_mapping import EnrichmentReference
 from simply_nwb.transforms import drifting_grating_metadata_read_from_filelist, labjack_concat_files
 
@@ -28,8 +29,12 @@ class DriftingGratingLabjackEnrichment(DriftingGratingEnrichment):
     a frame is 0 or 1, each time it flips is a new frame, 0 to 1, 1 to 0 etc..
     y3 misc analogue signal, per usecase
 
+    If transition_storage is True, the digital channels y0-y3 are stored as their transitions and Time as its start and
+    rate (when uniform), use labjack_channel() to get the dense signals back
     """
-    def __init__(self,  drifting_grating_metadata_filenames, dat_filenames, drifting_grating_channel="y1", video_frame_channel="y2", drifting_kwargs={}, labjack_kwargs={}, squarewave_args={}, skip_sparse_noise=False, sparse_noise_pulsecount_offset=340):
+    DIGITAL_CHANNELS = ["y0", "y1", "y2", "y3"]
+
+    def __init__(self,  drifting_grating_metadata_filenames, dat_filenames, drifting_grating_channel="y1", video_frame_channel="y2", drifting_kwargs={}, labjack_kwargs={}, squarewave_args={}, skip_sparse_noise=False, sparse_noise_pulsecount_offset=340, transition_storage=False):
         # If skip_sparse_noise is True, will find a gap in the grating signal and truncate up to it, to account for the
         # sparse noise in the first part of the recording, TODO integrate and parse sparse noise
 
@@ -51,6 +56,7 @@ class DriftingGratingLabjackEnrichment(DriftingGratingEnrichment):
         self.grating_channel = drifting_grating_channel
         self.frames_channel = video_frame_channel
         self.squarewave_args = squarewave_args
+        self.transition_storage = transition_storage  # Store digital channels as transitions, and Time as start/rate
 
     @property
     def dats(self):
@@ -112,6 +118,10 @@ class DriftingGratingLabjackEnrichment(DriftingGratingEnrichment):
 
         return self._gratings_startstop
 
+    def add_clock_mappings(self, clock: SessionClock):
+        labjack_time = np.asarray(self.dats["Time"])
+        clock.add_mapping("labjack_time", np.arange(len(labjack_time)), labjack_time)
+
     def _run(self, pynwb_obj):
         super()._run(pynwb_obj)
         self._save_val("sparse_skip_count", [self._sparse_skip], pynwb_obj)
@@ -121,9 +131,53 @@ class DriftingGratingLabjackEnrichment(DriftingGratingEnrichment):
 
         # drifting_grating_channel = "y1", video_frame_channel = "y2"
         self._sparse_skip = 0  # We want to put all the data in the NWB, including the spare noise stim data we skipped
+        self._save_labjack_channels(pynwb_obj)
+
+    def _save_labjack_channels(self, pynwb_obj):
+        # Save every labjack channel, dense or (if transition_storage) as transitions and Time as start/rate
         for k, v in self.dats.items():
+            if self.transition_storage and k in DriftingGratingLabjackEnrichment.DIGITAL_CHANNELS:
+                self._save_val(f"{k}_transitions", signal_transitions(v), pynwb_obj)
+                continue
+            if self.transition_storage and k == "Time":
+                time_info = self._uniform_time_info(v)
+                if time_info is not None:
+                    self._save_val("Time_uniform", time_info, pynwb_obj)
+                    continue
             self._save_val(k, v, pynwb_obj)
 
+    @staticmethod
+    def _uniform_time_info(labjack_time):
+        # [start, rate, num_samples] if the times are uniformly sampled, otherwise None
+        labjack_time = np.asarray(labjack_time, dtype=np.float64)
+        if labjack_time.size < 2 or labjack_time[-1] == labjack_time[0]:
+            return None
+        rate = (labjack_time.size - 1) / (labjack_time[-1] - labjack_time[0])
+        rebuilt = labjack_time[0] + np.arange(labjack_time.size) / rate
+        if np.max(np.abs(rebuilt - labjack_time)) > 1e-3 / rate:  # Allow a thousandth of a sample of error
+            return None
+        return [labjack_time[0], rate, labjack_time.size]
+
+    @staticmethod
+    def labjack_channel(pynwb_obj, channel):
+        # Get the dense labjack signal for a channel, regardless of how it was stored
+        name = DriftingGratingLabjackEnrichment.get_name()
+        keys = Enrichment.keys(name, pynwb_obj)
+        if channel in keys:
+            return Enrichment.get_val(name, channel, pynwb_obj)
+
+        if "Time" in keys:
+            num_samples = len(Enrichment.get_val(name, "Time", pynwb_obj))
+        else:
+            start, rate, num_samples = Enrichment.get_val(name, "Time_uniform", pynwb_obj)
+            num_samples = int(num_samples)
+            if channel == "Time":
+                return start + np.arange(num_samples) / rate
+
+        if f"{channel}_transitions" in keys:
+            return signal_from_transitions(Enrichment.get_val(name, f"{channel}_transitions", pynwb_obj), num_samples)
+        raise ValueError(f"Unable to find labjack channel '{channel}' in Enrichment '{name}' Available keys '{keys}'")
+
     @staticmethod
     def get_name() -> str:
         return "DriftingGratingLabjack"
@@ -133,6 +187,8 @@ class DriftingGratingLabjackEnrichment(DriftingGratingEnrichment):
         saved = DriftingGratingEnrichment.saved_keys()
         labjack_keys = ["Time", "v0", "v1", "v2", "v3", "y0", "y1", "y2", "y3"]
         saved.extend(labjack_keys)
+        saved.extend([f"{k}_transitions" for k in DriftingGratingLabjackEnrichment.DIGITAL_CHANNELS])
+        saved.append("Time_uniform")
         saved.extend(["sparse_skip_count", "sparse_noise_pulsecount_offset", "drifting_grating_channel", "video_channel"])
         return saved
 
@@ -152,10 +208,26 @@ class DriftingGratingLabjackEnrichment(DriftingGratingEnrichment):
             "sparse_skip_count": "How far into the labjack array (in indexes) does the driftingGrating stimulus starts, used to skip past initial sparse noise data in the labjack",
             "sparse_noise_pulsecount_offset": "Number of pulses that contain spare noise and were skipped during processing the driftingGratingMetadata.txt files",
             "drifting_grating_channel": "Labjack channel used for the drifting grating signal",
-            "video_channel": "Labjack channel used for the video frames channel"
+            "video_channel": "Labjack channel used for the video frames channel",
+            "Time_uniform": "[start, rate, num_samples] of the labjack times when stored compactly, use labjack_channel('Time') to get the times",
         })
+        for k in DriftingGratingLabjackEnrichment.DIGITAL_CHANNELS:
+            descs[f"{k}_transitions"] = f"Labjack channel {k} stored as (segments, [start index, value]), use labjack_channel('{k}') to get the signal"
         return descs
 
+    @staticmethod
+    def func_list() -> list[FuncInfo]:
+        funcs = DriftingGratingEnrichment.func_list()
+        funcs.append(FuncInfo(
+            "labjack_channel",
+            "Get the full labjack signal of a channel, works for channels stored as transitions",
+            {
+                "channel": "Name of the labjack channel, e.g. 'y0' or 'Time'"
+            },
+            "labjack_channel('y2') # Video frame signal (samples,)"
+        ))
+        return funcs
+
     @staticmethod
     def nasal_saccade_info(pynwb_obj, saccade_index=None):
         return DriftingGratingEnrichment._saccade_info(pynwb_obj, "nasal", saccade_index, DriftingGratingLabjackEnrichment.get_name())
@@ -163,3 +235,11 @@ class DriftingGratingLabjackEnrichment(DriftingGratingEnrichment):
     @staticmethod
     def temporal_saccade_info(pynwb_obj, saccade_index=None):
         return DriftingGratingEnrichment._saccade_info(pynwb_obj, "temporal", saccade_index, DriftingGratingLabjackEnrichment.get_name())
+
+    @staticmethod
+    def nasal_saccade_info_df(pynwb_obj, saccade_index=None):
+        return DriftingGratingEnrichment._saccade_info_df(pynwb_obj, "nasal", saccade_index, DriftingGratingLabjackEnrichment.get_name())
+
+    @staticmethod
+    def temporal_saccade_info_df(pynwb_obj, saccade_index=None):
+        return DriftingGratingEnrichment._saccade_info_df(pynwb_obj, "temporal", saccade_index, DriftingGratingLabjackEnrichment.get_name())
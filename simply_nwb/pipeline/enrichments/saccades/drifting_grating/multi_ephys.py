@@ -0,0 +1,158 @@
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from simply_nwb.pipeline import Enrichment
+from simply_nwb.pipeline.enrichments.saccades.drifting_grating.ephys import DriftingGratingEPhysEnrichment, labjack_requirements
+from simply_nwb.pipeline.funcinfo import FuncInfo
+from simply_nwb.pipeline.util.chunked import chunked_dataio
+from simply_nwb.pipeline.util.clock import SessionClock
+
+PROBE_KEYS = {
+    "spike_times_in_labjack_time": "Kilosort spike times of probe {} in terms of labjack time",
+    "spike_times_in_neuropixels_time": "Original Kilosort (not aligned) spike times of probe {} in neuropixels time",
+    "spike_clusters": "Unit ID associated with the spike times of probe {}"
+}
+
+
+def _align_probe(probe, np_barcode_fn, np_spike_clusts_fn, np_spike_times_fn, lj_barcode_indices, lj_barcode_vals, labjack_time_mapping, output_fn, chunk_size):
+    # Decode a probe's barcode and align its spikes to labjack time, run in a worker process
+    # Aligned spike times are written chunk by chunk into output_fn so they don't need to be sent back to the main process
+    aligner = DriftingGratingEPhysEnrichment(np_barcode_fn, np_spike_clusts_fn, np_spike_times_fn, chunk_size=chunk_size)
+    np_signal = aligner.extract_barcode_signals(aligner.np_barcode, DriftingGratingEPhysEnrichment.NEUROPIXELS_SAMPLING_RATE)
+    np_barcode_indices, np_barcode_vals = aligner._decode_valid_barcodes(np_signal, DriftingGratingEPhysEnrichment.NEUROPIXELS_SAMPLING_RATE, f"neuropixels probe {probe}")
+
+    matched_vals, common_lj, common_np = np.intersect1d(lj_barcode_vals, np_barcode_vals, return_indices=True)
+    if len(matched_vals) < 2:
+        raise ValueError(f"Probe '{probe}' only has '{len(matched_vals)}' barcodes in common with the labjack, cannot align!")
+
+    clock = SessionClock({
+        "labjack_time": labjack_time_mapping,
+        "neuropixels_sample": (lj_barcode_indices[common_lj], np_barcode_indices[common_np])
+    })
+
+    spike_times = aligner.spike_times
+    num_spikes = len(spike_times)
+    aligner.logger.info(f"Aligning {num_spikes} spikes of probe {probe} to labjack time..")
+    aligned = open_memmap(output_fn, mode="w+", dtype=np.float64, shape=(num_spikes,))
+    for i in range(0, num_spikes, chunk_size):
+        aligned[i:i + chunk_size] = clock.convert(np.asarray(spike_times[i:i + chunk_size]).ravel(), "neuropixels_sample", "labjack_time")
+    aligned.flush()
+    del aligned
+
+    return probe, clock.mappings["neuropixels_sample"]
+
+
+class DriftingGratingMultiEPhysEnrichment(DriftingGratingEPhysEnrichment):
+    """
+    Align the spikes of multiple neuropixels probes to labjack time, see DriftingGratingEPhysEnrichment
+
+    The labjack barcode is decoded once and shared, each probe's barcode is decoded and its spikes aligned in parallel
+    processes. Results are stored per probe like '<probe>_spike_times_in_labjack_time'
+    """
+    def __init__(self, probes: dict[str, tuple[str, str, str]], labjack_barcode_channel="y0", lj_timestamps_colname="Time", chunk_size=1_000_000, workers=None, output_dir=None):
+        """
+        :param probes: dict like {probe_name: (np_barcode_fn, np_spike_clusts_fn, np_spike_times_fn)}
+        :param labjack_barcode_channel: labjack channel with the barcode signal
+        :param lj_timestamps_colname: labjack column with the timestamps
+        :param chunk_size: Number of spikes to align and write at a time
+        :param workers: max number of processes to use, None for number of cpus
+        :param output_dir: directory to write the aligned spike times '<probe>_spike_times_in_labjack_time.npy' into,
+            defaults to the folder of each probe's spike times
+        """
+        Enrichment.__init__(self, labjack_requirements(lj_timestamps_colname, labjack_barcode_channel))  # Required that the labjack is already in file
+
+        if len(probes) == 0:
+            raise ValueError("Must provide at least one probe!")
+        for probe, fns in probes.items():
+            if len(fns) != 3:
+                raise ValueError(f"Probe '{probe}' must be (np_barcode_fn, np_spike_clusts_fn, np_spike_times_fn), got '{fns}'")
+            for fn in fns:
+                assert os.path.exists(fn), f"File '{fn}' for probe '{probe}' does not exist!"
+
+        self.probes = probes
+        # Keys depend on the probes, so the instance's keys shadow the static ones that don't know the probe names
+        self.saved_keys = functools.partial(DriftingGratingMultiEPhysEnrichment.probe_saved_keys, list(probes.keys()))
+        self.descriptions = functools.partial(DriftingGratingMultiEPhysEnrichment.probe_descriptions, list(probes.keys()))
+        self.labjack_barcode_channel = labjack_barcode_channel
+        self.lj_timestamps_colname = lj_timestamps_colname
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.output_dir = output_dir
+
+    def _output_fn(self, probe):
+        output_dir = self.output_dir
+        if output_dir is None:
+            output_dir = os.path.dirname(os.path.abspath(self.probes[probe][2]))
+        return os.path.join(output_dir, f"{probe}_spike_times_in_labjack_time.npy")
+
+    def _run(self, pynwb_obj):
+        lj_barcode_indices, lj_barcode_vals = self.decode_labjack_barcode(pynwb_obj)
+
+        clock = SessionClock.from_nwb(pynwb_obj)
+        if "labjack_time" not in clock.mappings:
+            labjack_time = self._get_req_val("labjack_time", pynwb_obj)
+            clock.add_mapping("labjack_time", np.arange(len(labjack_time)), labjack_time)
+
+        self.logger.info(f"Aligning probes {list(self.probes.keys())}..")
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = [
+                pool.submit(_align_probe, probe, *fns, lj_barcode_indices, lj_barcode_vals, clock.mappings["labjack_time"], self._output_fn(probe), self.chunk_size)
+                for probe, fns in self.probes.items()
+            ]
+            results = [f.result() for f in futures]
+
+        for probe, neuropixels_mapping in results:
+            clock.add_mapping(f"neuropixels_sample_{probe}", *neuropixels_mapping)
+
+            _, np_spike_clusts_fn, np_spike_times_fn = self.probes[probe]
+            spike_times = np.load(np_spike_times_fn, mmap_mode="r")
+            aligned = np.load(self._output_fn(probe), mmap_mode="r")
+            spike_clusts = np.load(np_spike_clusts_fn, mmap_mode="r")
+            self._save_val(f"{probe}_spike_times_in_neuropixels_time", chunked_dataio(spike_times, self.chunk_size), pynwb_obj)
+            self._save_val(f"{probe}_spike_times_in_labjack_time", chunked_dataio(aligned, self.chunk_size), pynwb_obj)
+            self._save_val(f"{probe}_spike_clusters", chunked_dataio(spike_clusts, self.chunk_size), pynwb_obj)
+
+        clock.save(pynwb_obj)
+        self._save_val("probes", list(self.probes.keys()), pynwb_obj)
+
+    @staticmethod
+    def get_name() -> str:
+        return "DriftingGratingMultiEPhys"
+
+    @staticmethod
+    def probe_saved_keys(probes: list[str]) -> list[str]:
+        """
+        Keys saved when aligning the given probes
+        """
+        keys = ["probes"]
+        for probe in probes:
+            keys.extend([f"{probe}_{k}" for k in PROBE_KEYS.keys()])
+        return keys
+
+    @staticmethod
+    def probe_descriptions(probes: list[str]) -> dict[str, str]:
+        """
+        Descriptions of the keys saved when aligning the given probes
+        """
+        descs = {"probes": "Names of the probes that were aligned"}
+        for probe in probes:
+            descs.update({f"{probe}_{k}": v.format(probe) for k, v in PROBE_KEYS.items()})
+        return descs
+
+    @staticmethod
+    def saved_keys() -> list[str]:
+        # Without an instance the probe names aren't known, only 'probes' is always saved
+        return DriftingGratingMultiEPhysEnrichment.probe_saved_keys([])
+
+    @staticmethod
+    def descriptions() -> dict[str, str]:
+        # Without an instance the probe names aren't known, describe the per-probe keys with a placeholder
+        return DriftingGratingMultiEPhysEnrichment.probe_descriptions(["<probe>"])
+
+    @staticmethod
+    def func_list() -> list[FuncInfo]:
+        return []
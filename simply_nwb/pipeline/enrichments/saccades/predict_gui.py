@@ -1,10 +1,13 @@
 import math
 import os
 import pickle
+import time
+import warnings
 
 import numpy as np
 from pynwb import NWBHDF5IO
 from sklearn.discriminant_analysis import LinearDiscriminantAnalysis
+from sklearn.exceptions import ConvergenceWarning
 
 from simply_nwb.pipeline import Enrichment
 from simply_nwb.pipeline.enrichments.saccades import PredictSaccadesEnrichment, PutativeSaccadesEnrichment
@@ -15,11 +18,22 @@ from simply_nwb.pipeline.util.saccade_gui.epochs import SaccadeEpochLabelingGUI
 from sklearn.multioutput import MultiOutputRegressor
 from sklearn.neural_network import MLPRegressor
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import GridSearchCV
+from sklearn.experimental import enable_halving_search_cv  # noqa, required to import HalvingGridSearchCV
+from sklearn.model_selection import HalvingGridSearchCV
 
 
 class PredictedSaccadeGUIEnrichment(PredictSaccadesEnrichment):
-    def __init__(self, recording_fps, list_of_putative_nwbs_filenames, num_training_samples, putative_kwargs):
+    def __init__(self, recording_fps, list_of_putative_nwbs_filenames, num_training_samples, putative_kwargs, epoch_search_budget=None, n_jobs=-1):
+        """
+        Create a new enrichment that trains the direction and epoch models from user labeled data in a GUI
+
+        :param recording_fps: fps of the eye recording
+        :param list_of_putative_nwbs_filenames: list of NWB filenames with the PutativeSaccades enrichment to sample from
+        :param num_training_samples: number of saccades to label in the GUI, at least 20
+        :param putative_kwargs: dict of kwargs for the PutativeSaccadesEnrichment used to validate the NWBs
+        :param epoch_search_budget: approximate wall time limit in seconds for each epoch model hyperparameter search, if None will use the env var NWB_EPOCH_SEARCH_BUDGET, if that is unset there is no limit
+        :param n_jobs: number of cores for the epoch model hyperparameter search, -1 for all
+        """
         super().__init__(None, None, None, None, None)
         self.putat_nwbs = []
         self.putat_nwb_fps = []  # TODO atexit close?
@@ -43,6 +57,10 @@ class PredictedSaccadeGUIEnrichment(PredictSaccadesEnrichment):
             self.putat_nwbs.append(nwb)
 
         self.recording_fps = recording_fps
+        if epoch_search_budget is None and "NWB_EPOCH_SEARCH_BUDGET" in os.environ:
+            epoch_search_budget = float(os.environ["NWB_EPOCH_SEARCH_BUDGET"])
+        self.epoch_search_budget = epoch_search_budget
+        self.n_jobs = n_jobs
 
     def _get_direction_prelabeled_data_name(self):
         return "predict_gui_directional_trainingdata.pickle"
@@ -83,8 +101,7 @@ class PredictedSaccadeGUIEnrichment(PredictSaccadesEnrichment):
 
         gui = SaccadeDirectionLabelingGUI()
         gui.inputSamples(putative_waveforms[putative_idxs, :, 0])  # 0 is x
-        while gui.isRunning():
-            continue
+        gui.wait()
         x, y = gui.trainingData
 
         # debug testing
@@ -121,8 +138,7 @@ class PredictedSaccadeGUIEnrichment(PredictSaccadesEnrichment):
         gui = SaccadeEpochLabelingGUI()
         nonzero_idxs = np.logical_not(pred_labels == 0)[:, 0]  # Dont label epochs of noise
         gui.inputSamples(pred_waveforms[nonzero_idxs], pred_labels[nonzero_idxs])
-        while gui.isRunning():
-            continue
+        gui.wait()
 
         train_x, train_y, train_z = gui.trainingData
         train_y = train_y / self.recording_fps  # Divide by recording fps to get epochs in units of frames
@@ -181,7 +197,7 @@ class PredictedSaccadeGUIEnrichment(PredictSaccadesEnrichment):
             if len(ty) == 0:
                 raise ValueError(f"Can't train model with direction = {direc} no epoch training data!")
 
-            reg, tra = self.get_pretrained_epoch_models(tx, ty)
+            reg, tra = self.get_pretrained_epoch_models(tx, ty, features=self.format_epoch_features(tx), budget=self.epoch_search_budget, n_jobs=self.n_jobs)
             models.append(reg)
             models.append(tra)
 
@@ -288,11 +304,48 @@ class PredictedSaccadeGUIEnrichment(PredictSaccadesEnrichment):
         # return DirectionalClassifier()
 
     @staticmethod
-    def get_pretrained_epoch_models(wv, epoch_labels):
-        num_features = 30
-        # x vals of the waveforms for training on, handpicked and corresponding to the epoch_labels below
+    def format_epoch_features(wv, num_features=30):
+        # x vals of the waveforms for training on, handpicked and corresponding to the epoch labels
         tmp_wv = np.broadcast_to(wv[:, :, None], shape=(*wv.shape, 2))  # pretend this epoch waveform is a direction to use the same preprocessing func
-        training_x_waveforms, idxs = PredictSaccadesEnrichment.preformat_waveforms(tmp_wv, num_features=num_features)
+        return PredictSaccadesEnrichment.preformat_waveforms(tmp_wv, num_features=num_features)
+
+    @staticmethod
+    def _budget_max_iter(budget, training_x, training_y, num_candidates, cv, factor, n_jobs):
+        # Estimate the max number of MLP iterations (the halving resource) so that the search stays within 'budget' seconds
+        # Time a short fit of the largest network to get the cost of one iteration
+        calib_iters = 20
+        calib = MLPRegressor(hidden_layer_sizes=(32,), max_iter=calib_iters, n_iter_no_change=calib_iters + 1)
+        start = time.time()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=ConvergenceWarning)
+            MultiOutputRegressor(calib).fit(training_x, training_y)
+        iter_cost = (time.time() - start) / calib_iters
+
+        # Each halving round costs about num_candidates * min_resources * cv iterations in total
+        num_rounds = 1 + math.floor(math.log(num_candidates, factor))
+        cores = os.cpu_count() if n_jobs is None or n_jobs < 0 else n_jobs
+        total_iters = budget * max(cores, 1) / max(iter_cost, 1e-9)
+        min_iters = total_iters / (num_rounds * num_candidates * cv)
+        return max(int(min_iters * factor ** (num_rounds - 1)), factor ** (num_rounds - 1))
+
+    @staticmethod
+    def get_pretrained_epoch_models(wv, epoch_labels, features=None, budget=None, n_jobs=-1):
+        """
+        Train the epoch regressor and transformer with a successive halving search over the MLP hyperparameters,
+        using the max number of iterations as the resource and early stopping for each candidate
+
+        :param wv: waveforms (N, t)
+        :param epoch_labels: epoch start/stop for each waveform (N, 2)
+        :param features: precomputed result of format_epoch_features(wv) to avoid reformatting the waveforms
+        :param budget: approximate wall time limit in seconds for the search, None for no limit
+        :param n_jobs: number of cores to use for the search, -1 for all
+        :return: regressor, transformer
+        """
+        num_features = 30
+        if features is None:
+            features = PredictedSaccadeGUIEnrichment.format_epoch_features(wv, num_features=num_features)
+        training_x_waveforms, idxs = features
+        epoch_labels = np.array(epoch_labels)[idxs]  # Only use the labels of the waveforms that were formatted
 
         # Transformer
         transformer = StandardScaler().fit(epoch_labels)
@@ -301,11 +354,9 @@ class PredictedSaccadeGUIEnrichment(PredictSaccadesEnrichment):
         # Smaller grid for faster (but worse) training, used for testing
         if "NWB_DEBUG" in os.environ and os.environ["NWB_DEBUG"] == "True":
             hidden_layer_sizes = [(5,)]
+            max_iter = 1000
             grid = {
                 'estimator__hidden_layer_sizes': hidden_layer_sizes,
-                'estimator__max_iter': [
-                    1000,
-                ],
                 'estimator__activation': ['tanh'],  # , 'relu'],
                 'estimator__solver': ['sgd'],  # , 'adam'],
                 'estimator__alpha': [0.0001],  # , 0.05],
@@ -316,19 +367,37 @@ class PredictedSaccadeGUIEnrichment(PredictSaccadesEnrichment):
             hidden_layer_sizes = [(int(math.pow(2, v)),) for v in range(3, 6)]  # Try layer sizes 8,16,32
             # 1 2 4 8 16 32 64 128
             # 0 1 2 3  4  5  6  7
+            max_iter = 1000000
             grid = {
                 'estimator__hidden_layer_sizes': hidden_layer_sizes,
-                'estimator__max_iter': [
-                    1000000,
-                ],
                 'estimator__activation': ['tanh', 'relu'],
                 'estimator__solver': ['adam'],
                 'estimator__alpha': [0.0001, 0.05],
                 'estimator__learning_rate': ['constant', 'adaptive'],
             }
 
-        reg = MultiOutputRegressor(MLPRegressor(verbose=True))
-        search = GridSearchCV(reg, grid)
+        num_candidates = int(np.prod([len(v) for v in grid.values()]))
+        cv = 5
+        factor = 3
+        if budget is not None:
+            budget_iter = PredictedSaccadeGUIEnrichment._budget_max_iter(budget, training_x_waveforms, standardized_epoch_labels, num_candidates, cv, factor, n_jobs)
+            print(f"Limiting epoch model search to '{budget_iter}' iterations to fit in the budget of '{budget}' seconds")
+            max_iter = min(max_iter, budget_iter)
+
+        # max_iter is the resource that is successively increased for the best candidates, early stopping
+        # ends training for a candidate when the validation score stops improving
+        reg = MultiOutputRegressor(MLPRegressor(early_stopping=True))
+        search = HalvingGridSearchCV(
+            reg,
+            grid,
+            resource="estimator__max_iter",
+            max_resources=max_iter,
+            min_resources="exhaust",
+            factor=factor,
+            cv=cv,
+            n_jobs=n_jobs,
+            verbose=1
+        )
 
         search.fit(training_x_waveforms, standardized_epoch_labels)
         regressor = search.best_estimator_
@@ -1,7 +1,10 @@
 import base64
+import hashlib
+import inspect
 import math
 import os
-import random
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 
 
@@ -25,6 +28,41 @@ from simply_nwb.pipeline.util.saccade_gui.data_generator import DirectionDataGen
 from simply_nwb.transforms import eyetracking_load_dlc, csv_load_dataframe
 
 
+DLC_UNITS = ["idx", "px", "px", "likelihood", "px", "px", "likelihood", "px", "px", "likelihood", "px", "px",
+             "likelihood", "px", "px", "likelihood"]
+EYEPOS_CACHE_VERSION = 1  # Bump when the eye position processing changes in a way the putative source hash can't see
+
+
+def _hash_training_files(timestamps_txt, dlc_csv, xkey, ykey, likeli):
+    # Content hash of the raw DLC inputs (and the column keys used), used as the cache key for processed eye positions
+    # Also hashes the cache version and the putative pipeline's source, so changes to the processing invalidate the cache
+    hsh = hashlib.sha256()
+    hsh.update(f"v{EYEPOS_CACHE_VERSION}".encode("utf-8"))
+    with open(inspect.getsourcefile(PutativeSaccadesEnrichment), "rb") as f:
+        hsh.update(f.read())
+    for fn in [dlc_csv, timestamps_txt]:
+        with open(fn, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                hsh.update(block)
+    hsh.update(f"{xkey},{ykey},{likeli}".encode("utf-8"))
+    return hsh.hexdigest()
+
+
+def _process_eyepos(timestamps_txt, dlc_csv, xkey, ykey, likeli):
+    # Run the putative pipeline on a single DLC file, top-level func so it can be pickled into a process pool
+    sess = NWBSession(SimpleNWB.test_nwb())
+    sess.enrich(PutativeSaccadesEnrichment.from_raw(
+        sess.nwb, dlc_csv, timestamps_txt,
+        units=DLC_UNITS,
+        x_center=xkey,
+        y_center=ykey,
+        likelihood=likeli
+    ))
+    eyepos = sess.pull("PutativeSaccades.processed_eyepos")[:, 0]  # Grab first dim since its x/y
+    likelihoods = sess.pull("PutativeSaccades.raw_likelihoods")
+    return eyepos, likelihoods
+
+
 class WrappedMLModel(object):
     def __init__(self, model):
         self.model = model
@@ -88,11 +126,71 @@ class PredictSaccadeMLEnrichment(PredictSaccadesEnrichment):
         return wvv, pstart, pend
 
     @staticmethod
-    def process_trainingdata(training_datas: list[tuple[str, str, str]], xkey="center_x", ykey="center_y", likeli="center_likelihood", generate_data=True):
+    def load_training_eyepos(training_datas: list[tuple[str, str, str]], xkey="center_x", ykey="center_y", likeli="center_likelihood", cache_dir=None, workers=None) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Run the PutativeSaccades pipeline on each (labeled_csv, timestamps_txt, dlc_csv) triple to get the processed
+        eye positions and likelihoods. If cache_dir is given, results are cached in it keyed by a hash of the DLC and
+        timestamp files and the processing code, so unchanged files are never reprocessed. Uncached files are processed in parallel in a process pool
+
+        :param training_datas: list of (labeled_csv, timestamps_txt, dlc_csv) filenames
+        :param xkey: DLC column name for the x position
+        :param ykey: DLC column name for the y position
+        :param likeli: DLC column name for the likelihood
+        :param cache_dir: Optional directory to store the processed eye positions in, defaults to None (no caching)
+        :param workers: max number of processes to use, None for number of cpus
+        :return: list of (eyepos, likelihoods) in the same order as training_datas
+        """
+        results = [None] * len(training_datas)
+        to_process = {}  # idx: cache filename
+
+        for idx, (_, timestamps_txt, dlc_csv) in enumerate(training_datas):
+            cache_fn = None
+            if cache_dir is not None:
+                digest = _hash_training_files(timestamps_txt, dlc_csv, xkey, ykey, likeli)
+                cache_fn = os.path.join(cache_dir, f"{digest}.npz")
+                if os.path.exists(cache_fn):
+                    print(f"Using cached eye positions for '{dlc_csv}'..")
+                    cached = np.load(cache_fn)
+                    results[idx] = (cached["eyepos"], cached["likelihoods"])
+                    continue
+            to_process[idx] = cache_fn
+
+        if not to_process:
+            return results
+
+        print(f"Processing '{len(to_process)}' DLC file(s)..")
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for idx in to_process.keys():
+                _, timestamps_txt, dlc_csv = training_datas[idx]
+                futures[idx] = pool.submit(_process_eyepos, timestamps_txt, dlc_csv, xkey, ykey, likeli)
+
+            for idx, future in futures.items():
+                eyepos, likelihoods = future.result()
+                results[idx] = (eyepos, likelihoods)
+                cache_fn = to_process[idx]
+                if cache_fn is not None:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    # Write to a temp file and move it into place so an interrupted write never leaves a partial cache
+                    fd, tmp_fn = tempfile.mkstemp(suffix=".npz", dir=cache_dir)
+                    try:
+                        with os.fdopen(fd, "wb") as f:
+                            np.savez(f, eyepos=eyepos, likelihoods=likelihoods)
+                        os.replace(tmp_fn, cache_fn)
+                    except BaseException:
+                        os.remove(tmp_fn)
+                        raise
+
+        return results
+
+    @staticmethod
+    def process_trainingdata(training_datas: list[tuple[str, str, str]], xkey="center_x", ykey="center_y", likeli="center_likelihood", generate_data=True, cache_dir=None, workers=None, seed=None):
         training_x = []  # will be a numpy array of size (N, 80) N = training samples given
         training_y = []  # numpy array like (N,) with
         print("Loading training data..")
-        for labeled_csv, timestamps_txt, dlc_csv in training_datas:
+        eyepos_list = PredictSaccadeMLEnrichment.load_training_eyepos(training_datas, xkey, ykey, likeli, cache_dir=cache_dir, workers=workers)
+
+        for (labeled_csv, timestamps_txt, dlc_csv), (eyepos, likelihoods) in zip(training_datas, eyepos_list):
             print(f"Loading '{labeled_csv}'..")
             # raw_eyepos = eyetracking_load_dlc(dlc_csv)[xkey].to_numpy()
             labeled = csv_load_dataframe(
@@ -105,20 +203,7 @@ class PredictSaccadeMLEnrichment(PredictSaccadesEnrichment):
             waveform_windows = []  # [[start, end], ..] of each saccade, used to find noise from nonlabeled
             # current standard temporal is -1, nasal is 1 need to convert the 0,1
 
-            # with open(timestamps_txt, "r") as f:
-            #     timestamps = {int(t.strip()): idx for idx, t in enumerate(f.readlines())}
-            sess = NWBSession(SimpleNWB.test_nwb())
-            sess.enrich(PutativeSaccadesEnrichment.from_raw(
-                sess.nwb, dlc_csv, timestamps_txt,
-                units=["idx", "px", "px", "likelihood", "px", "px", "likelihood", "px", "px", "likelihood", "px", "px",
-                       "likelihood", "px", "px", "likelihood"],
-                x_center=xkey,
-                y_center=ykey,
-                likelihood=likeli
-            ))
             # Process all labeled saccades
-            eyepos = sess.pull("PutativeSaccades.processed_eyepos")[:, 0]  # Grab first dim since its x/y
-            likelihoods = sess.pull("PutativeSaccades.raw_likelihoods")
             for idx, labelval in enumerate(labeled[timecol].to_numpy()):
                 if labelval + 80 > len(eyepos):
                     warnings.warn(
@@ -149,7 +234,7 @@ class PredictSaccadeMLEnrichment(PredictSaccadesEnrichment):
 
             # Sample noise for training
             noise = PredictSaccadeMLEnrichment.select_noise_vel_waveforms(waveform_windows, eyepos, likelihoods,
-                                                                      len(waveform_windows))
+                                                                      len(waveform_windows), seed=seed)
             training_x.extend(noise)
             training_y.extend([0] * len(noise))  # 0 for noise
 
@@ -158,12 +243,12 @@ class PredictSaccadeMLEnrichment(PredictSaccadesEnrichment):
 
         if generate_data:
             print("Generating extra data")
-            training_x, training_y = DirectionDataGenerator(training_x, training_y[:, None]).generate()
+            training_x, training_y = DirectionDataGenerator(training_x, training_y[:, None], seed=seed).generate()
 
         return training_x, training_y
 
     @staticmethod
-    def retrain(training_datas: list[tuple[str, str, str]], save_filename: str, xkey="center_x", ykey="center_y", likeli="center_likelihood", save_to_default_model=False, generate_data=True):
+    def retrain(training_datas: list[tuple[str, str, str]], save_filename: str, xkey="center_x", ykey="center_y", likeli="center_likelihood", save_to_default_model=False, generate_data=True, cache_dir=None, workers=None, epochs=200, batch_size=256, seed=None):
         """
         Re-train a model using given a list of training data files like
         [('saccade_times.csv', 'timestamps.txt', dlc.csv'), ...] where each (..) is it's own training dataset
@@ -179,12 +264,27 @@ class PredictSaccadeMLEnrichment(PredictSaccadesEnrichment):
         save_to_default_model is used to include the model in the package by default, writing to direction_model.py file
         which can be copied into simply_nwb/pipeline/util/models to replace the model that comes installed with the
         package. For the epoch models, you can use test/save_models_to_py.py and move those into that folder as well
+
+        If 'cache_dir' is given, the processed eye positions of each dlc.csv are cached in it (keyed by a hash of the dlc
+        and timestamps files and the processing code), so re-training with different model parameters skips the eye
+        position processing. 'workers' is the number of processes used to process uncached files
+
+        The model is trained incrementally with partial_fit for 'epochs' passes over the data in mini-batches of
+        'batch_size'. This replaces the previous full fit that ran to convergence with max_iter=10000, so 'epochs' is
+        now what bounds training. When generate_data is True the augmented data is generated batch by batch, so the
+        returned training_x and training_y are the un-augmented training data. Pass a 'seed' for reproducible training
         """
 
         # training_x, training_y = PredictSaccadeMLEnrichment.process_trainingdata(training_datas, xkey, ykey, likeli, generate_data=False)
         # training_x = training_x[:20]
         # training_y = training_y[:20]
-        training_x, training_y = PredictSaccadeMLEnrichment.process_trainingdata(training_datas, xkey, ykey, likeli, generate_data=generate_data)
+        training_x, training_y = PredictSaccadeMLEnrichment.process_trainingdata(training_datas, xkey, ykey, likeli, generate_data=False, cache_dir=cache_dir, workers=workers, seed=seed)
+        if generate_data:
+            print("Generating extra data during training")
+            generator = DirectionDataGenerator(training_x, training_y[:, None], seed=seed)
+        else:
+            generator = None
+        classes = np.unique(training_y)
 
         mlp_clf = MLPClassifier(
             activation='tanh',
@@ -193,9 +293,10 @@ class PredictSaccadeMLEnrichment(PredictSaccadesEnrichment):
             learning_rate="adaptive",
             # 80 xpoints
             max_iter=10000,
-            verbose=True,
+            verbose=False,  # Loss is printed once per epoch below, partial_fit would print every batch
             shuffle=True,
-            n_iter_no_change=10000
+            n_iter_no_change=10000,
+            random_state=seed
         )
         mlp_clf.out_activation_ = "softmax"
 
@@ -238,7 +339,17 @@ class PredictSaccadeMLEnrichment(PredictSaccadesEnrichment):
         # trained_model = WrappedMLModel(search)
 
         print("Starting Neural Network training, might take a bit..")
-        mlp_clf.fit(training_x, training_y)
+        rng = np.random.default_rng(seed)
+        for epoch in range(epochs):
+            if generator is not None:
+                batches = generator.batches(batch_size)
+            else:
+                order = rng.permutation(len(training_y))
+                batches = ((training_x[order[i:i + batch_size]], training_y[order[i:i + batch_size]]) for i in range(0, len(order), batch_size))
+
+            for batch_x, batch_y in batches:
+                mlp_clf.partial_fit(batch_x, np.ravel(batch_y), classes=classes)
+            print(f"Epoch {epoch + 1}/{epochs}, loss = {mlp_clf.loss_}")
         trained_model = WrappedMLModel(mlp_clf)
 
         if save_to_default_model:
@@ -282,50 +393,43 @@ class PredictSaccadeMLEnrichment(PredictSaccadesEnrichment):
     #             count = count + 1
 
     @staticmethod
-    def select_noise_vel_waveforms(waveform_windows, eyepos, likelihoods, num_samples):
+    def select_noise_vel_waveforms(waveform_windows, eyepos, likelihoods, num_samples, seed=None, half_width=40):
         """
         Select some waveforms from the full eyeposition to label as noise.
-        Takes the peaks and troughs of the eyeposition, then randomly selects one, if that value intersects with
-        a labeled saccade, re-pick. Do this until all requested samples are pulled. (could be optimized)
+        Takes the peaks and troughs of the eye velocity, removes any where the window around it intersects with a
+        labeled saccade, then randomly selects num_samples of the remaining peaks (without replacement)
+
+        :param waveform_windows: list of [start, end] eyepos indexes of the labeled saccades
+        :param eyepos: eye positions (time,)
+        :param likelihoods: likelihoods of the eye positions (time,) currently unused
+        :param num_samples: number of noise waveforms to select
+        :param seed: seed for the random number generator, None for a random selection
+        :param half_width: half of the length of the position waveform around each peak, defaults to 40 (80 total)
+        :return: np.ndarray of noise velocity waveforms (num_samples, half_width*2 - 1)
         """
-
-        count = 0
-        loops = 0
         eyevel = np.diff(eyepos)  # Eye velocity, forward difference
         up_peaks = find_peaks(eyevel)
         down_peaks = find_peaks(eyevel*-1)
 
         # Combine and make unique
-        peaks = [*list(up_peaks[0]), *list(down_peaks[0])]
-        peaks = np.array(list(set(peaks)))
-
-        if len(peaks) < num_samples*3/4:
-            raise ValueError("Cannot select noise waveforms, num samples must be at most 3/4 of the peaks found!")
-
-        def within(x, w):
-            return (x <= w[1]) and (x >= w[0])
-
-        samples = []
-
-        while True:  # Could make this better but its not worth the time lol
-            loops = loops + 1
-            if loops >= 10000000:
-                raise ValueError("Unable to sample noise waveforms!")  # TODO if this happens fix the sampling lol
-
-            if count >= num_samples:
-                return samples
-
-            found = False
-            p_idx = random.randint(0, len(peaks))
-            idx = peaks[p_idx]
-
-            for wind in waveform_windows:
-                if within(idx - 40, wind) or within(idx + 40, wind):
-                    found = True
-                    break
-            if not found:
-                # samples.append([*eyepos[idx:idx+80], *likelihoods[idx:idx+80]])  # TODO include likelihoods?
-                wv = eyepos[idx - 40:idx + 40]
-                if len(wv) == 80:  # .diff will turn 80 -> 79
-                    samples.append(np.diff(wv))
-                    count = count + 1
+        peaks = np.union1d(up_peaks[0], down_peaks[0])
+
+        # Boolean mask of every eyepos index that falls within a labeled window (inclusive on both ends)
+        edges = np.zeros(len(eyepos) + 2, dtype=int)
+        windows = np.clip(np.array(waveform_windows, dtype=int).reshape(-1, 2), 0, len(eyepos))
+        np.add.at(edges, windows[:, 0], 1)
+        np.add.at(edges, windows[:, 1] + 1, -1)
+        labeled_mask = np.cumsum(edges)[:len(eyepos) + 1] > 0
+
+        # Peak needs a full window around it, and neither end of the window can be inside a labeled saccade
+        peaks = peaks[(peaks >= half_width) & (peaks + half_width <= len(eyepos))]
+        peaks = peaks[np.invert(labeled_mask[peaks - half_width] | labeled_mask[peaks + half_width])]
+
+        if len(peaks) < num_samples:
+            raise ValueError(f"Unable to sample noise waveforms! Requested '{num_samples}' but only '{len(peaks)}' unlabeled peaks were found")
+
+        rng = np.random.default_rng(seed)
+        selected = rng.choice(peaks, size=num_samples, replace=False)
+        wv_idxs = selected[:, None] + np.arange(-half_width, half_width)[None, :]
+        # samples.append([*eyepos[idx:idx+80], *likelihoods[idx:idx+80]])  # TODO include likelihoods?
+        return np.diff(eyepos[wv_idxs], axis=1)  # .diff will turn 80 -> 79
@@ -0,0 +1,67 @@
+from typing import Callable, Optional
+
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import GenericDataChunkIterator
+
+
+class ArrayChunkIterator(GenericDataChunkIterator):
+    """
+    Iterate over an array (usually a np.memmap) along the first axis in fixed-size chunks, optionally transforming each
+    chunk as it is read. Used to write large datasets into the NWB without loading them into memory
+    """
+    def __init__(self, arr, chunk_len: int = 1_000_000, transform: Optional[Callable] = None, dtype=None, **kwargs):
+        """
+        :param arr: array-like to iterate over, must support slicing along the first axis
+        :param chunk_len: number of entries along the first axis in each chunk
+        :param transform: Optional func(chunk) -> chunk applied to each chunk, must keep the shape of the chunk
+        :param dtype: dtype of the transformed data, defaults to the dtype of arr
+        :param kwargs: extra kwargs to pass to GenericDataChunkIterator
+        """
+        if len(arr) == 0:
+            raise ValueError("Cannot iterate over an empty array!")
+        self.arr = arr
+        self.transform = transform
+        self._dtype = np.dtype(dtype) if dtype is not None else arr.dtype
+
+        chunk_shape = (min(chunk_len, len(arr)), *arr.shape[1:])
+        kwargs.setdefault("chunk_shape", chunk_shape)
+        kwargs.setdefault("buffer_shape", chunk_shape)
+        kwargs.setdefault("display_progress", False)
+        super().__init__(**kwargs)
+
+    def _get_data(self, selection):
+        data = np.asarray(self.arr[selection])
+        if self.transform is not None:
+            data = self.transform(data)
+        return data.astype(self._dtype, copy=False)
+
+    def _get_maxshape(self):
+        return self.arr.shape
+
+    def _get_dtype(self):
+        return self._dtype
+
+    def __getitem__(self, item):
+        # Allow reading back values before the NWB has been written
+        return self._get_data(item)
+
+    def __len__(self):
+        return len(self.arr)
+
+
+def chunked_dataio(arr, chunk_len: int = 1_000_000, transform: Optional[Callable] = None, dtype=None, compression: str = "gzip") -> H5DataIO:
+    """
+    Wrap an array in a chunked, compressed H5DataIO that is read (and transformed) chunk by chunk as it is written
+
+    :param arr: array-like to write, usually a np.memmap
+    :param chunk_len: number of entries along the first axis in each chunk
+    :param transform: Optional func(chunk) -> chunk applied to each chunk
+    :param dtype: dtype of the transformed data, defaults to the dtype of arr
+    :param compression: HDF5 compression to use, defaults to gzip
+    :returns: H5DataIO to use as the data of a TimeSeries
+    """
+    return H5DataIO(
+        data=ArrayChunkIterator(arr, chunk_len=chunk_len, transform=transform, dtype=dtype),
+        compression=compression
+    )
@@ -0,0 +1,115 @@
+import numpy as np
+from pynwb import NWBFile, TimeSeries
+
+from simply_nwb import SimpleNWB
+
+
+class SessionClock(object):
+    """
+    Convert times between the clocks of a session (camera frames, labjack samples, labjack time, neuropixels samples)
+
+    Every clock ('domain') is stored as a monotonic lookup table against the labjack sample index, the global clock.
+    Values are converted by linearly interpolating into the source table to get labjack samples and then out of the
+    destination table. The tables are persisted in the 'SessionClock' processing module of the NWB so each enrichment
+    can add the clocks it knows about and later enrichments can reuse them
+    """
+    HUB = "labjack_sample"
+    MODULE_NAME = "SessionClock"
+
+    def __init__(self, mappings: dict[str, tuple[np.ndarray, np.ndarray]] = None):
+        """
+        :param mappings: Optional dict like {domain: (labjack_samples, domain_values)}
+        """
+        self.mappings = {}
+        for domain, (hub_values, domain_values) in (mappings or {}).items():
+            self.add_mapping(domain, hub_values, domain_values)
+
+    def domains(self) -> list[str]:
+        return [SessionClock.HUB, *self.mappings.keys()]
+
+    def add_mapping(self, domain: str, hub_values, domain_values, compress: bool = True):
+        """
+        Add a clock to the session
+
+        :param domain: name of the clock, e.g. 'frame'
+        :param hub_values: labjack sample index of each entry in domain_values
+        :param domain_values: value of the clock at each of the labjack samples
+        :param compress: If True and the mapping is linear, only the endpoints are stored
+        """
+        hub_values = np.asarray(hub_values, dtype=np.float64).ravel()
+        domain_values = np.asarray(domain_values, dtype=np.float64).ravel()
+        if domain == SessionClock.HUB:
+            raise ValueError(f"Cannot add a mapping for the '{SessionClock.HUB}' clock, all clocks map to it!")
+        if hub_values.size != domain_values.size or hub_values.size < 2:
+            raise ValueError(f"Clock '{domain}' needs at least 2 matching labjack samples and values, got '{hub_values.size}' and '{domain_values.size}'")
+        if np.any(np.diff(hub_values) < 0) or np.any(np.diff(domain_values) < 0):
+            raise ValueError(f"Clock '{domain}' lookup table must be monotonically increasing!")
+
+        if compress:
+            line = np.interp(hub_values, hub_values[[0, -1]], domain_values[[0, -1]])
+            if np.allclose(line, domain_values, rtol=0, atol=1e-9 * max(1.0, np.abs(domain_values).max())):
+                hub_values = hub_values[[0, -1]]
+                domain_values = domain_values[[0, -1]]
+
+        self.mappings[domain] = (hub_values, domain_values)
+
+    def _check_domain(self, domain: str):
+        if domain != SessionClock.HUB and domain not in self.mappings:
+            raise ValueError(f"Unknown clock '{domain}'! Available clocks '{self.domains()}'")
+
+    def convert(self, values, src: str, dst: str) -> np.ndarray:
+        """
+        Convert values from one clock to another
+
+        :param values: array of values in the src clock
+        :param src: name of the clock the values are in
+        :param dst: name of the clock to convert to
+        :returns: array of values in the dst clock, same shape as values
+        """
+        self._check_domain(src)
+        self._check_domain(dst)
+        values = np.asarray(values, dtype=np.float64)
+        if src == dst:
+            return values
+
+        hub = values
+        if src != SessionClock.HUB:
+            src_hub, src_values = self.mappings[src]
+            hub = np.interp(values, src_values, src_hub)
+        if dst == SessionClock.HUB:
+            return hub
+        dst_hub, dst_values = self.mappings[dst]
+        return np.interp(hub, dst_hub, dst_values)
+
+    def save(self, nwb: NWBFile):
+        """
+        Persist the clocks into the NWB, clocks that are already in the NWB are left as is
+        """
+        existing = []
+        if SessionClock.MODULE_NAME in nwb.processing:
+            existing = list(nwb.processing[SessionClock.MODULE_NAME].containers.keys())
+
+        for domain, (hub_values, domain_values) in self.mappings.items():
+            if domain in existing:
+                continue
+            ts = TimeSeries(
+                name=domain,
+                data=np.stack([hub_values, domain_values], axis=1),
+                unit="val",
+                rate=1.0,
+                description=f"Lookup table (entries, [{SessionClock.HUB}, {domain}]) for the '{domain}' clock"
+            )
+            SimpleNWB.add_to_processing_module(nwb, ts, SessionClock.MODULE_NAME, "Session clock lookup tables, see simply_nwb.pipeline.util.clock.SessionClock")
+
+    @staticmethod
+    def from_nwb(nwb: NWBFile) -> "SessionClock":
+        """
+        Load the clocks persisted in the NWB, if there are none, an empty clock is returned
+        """
+        clock = SessionClock()
+        if SessionClock.MODULE_NAME in nwb.processing:
+            module = nwb.processing[SessionClock.MODULE_NAME]
+            for domain in module.containers.keys():
+                table = np.asarray(module[domain].data[:])
+                clock.mappings[domain] = (table[:, 0], table[:, 1])
+        return clock
@@ -1,5 +1,4 @@
 import numpy as np
-import plotly.express as px
 import plotly.graph_objects as go
 import plotly.subplots
 import scipy
@@ -147,35 +146,69 @@ class DirectionalClassifier(object):
         doprint("-" * 20)
         return False
 
-    def predict(self, data):
-        # data is (saccadenum, t)
-        predicts = []
-        for idx in range(data.shape[0]):
-            sacc = data[idx, :]
-            # import matplotlib.pyplot as plt
-            # plt.plot(sacc)
-            # plt.show()
-            if self.is_too_noisy(sacc, True, True):
-                predicts.append(0)
+    def noisy_mask(self, data):
+        """
+        Same checks as is_too_noisy for every waveform at once, the normalization and flatness checks are done with
+        axis reductions and only the peak prominence check (find_peaks) is run per waveform, on the waveforms that
+        aren't already flagged as noisy
+
+        :param data: waveforms (saccadenum, t)
+        :returns: boolean arr (saccadenum,) True where the waveform is too noisy
+        """
+        data = np.asarray(data, dtype=float)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Make each waveform positive then normalize to a range of 1
+            mins = np.min(data, axis=1, keepdims=True)
+            full_wv = data + np.where(mins < 0, mins * -1, 0)
+            full_wv = full_wv / np.abs(np.max(full_wv, axis=1, keepdims=True) - np.min(full_wv, axis=1, keepdims=True))
+            full_rnge = np.max(full_wv, axis=1) - np.min(full_wv, axis=1)
+
+            noisy = np.invert(np.all(np.isfinite(full_wv), axis=1))
+
+            # Flatness of the beginning and end of the waveforms
+            for subwave in [full_wv[:, :30], full_wv[:, -30:]]:
+                noisy |= np.abs(np.std(subwave, axis=1) / full_rnge) > .15
+                noisy |= (np.max(subwave, axis=1) - np.min(subwave, axis=1)) / full_rnge > .45
+
+            # Smoothed, normalized velocities for the peak checks
+            normalized = full_wv / (np.max(full_wv, axis=1, keepdims=True) - np.min(full_wv, axis=1, keepdims=True))
+            velocity = np.diff(normalized, axis=1)
+            vel_mins = np.min(velocity, axis=1, keepdims=True)
+            velocity = velocity + np.where(vel_mins < 0, np.abs(vel_mins), 0)
+
+            smoothed = scipy.ndimage.gaussian_filter1d(velocity, 4, axis=1)
+            smoothed = smoothed / (np.max(smoothed, axis=1, keepdims=True) - np.min(smoothed, axis=1, keepdims=True))
+            smoothed = smoothed + np.abs(np.min(smoothed, axis=1, keepdims=True))
+            smoothed = smoothed - np.mean(smoothed, axis=1, keepdims=True)
+            flip = np.abs(np.min(smoothed, axis=1)) > np.abs(np.max(smoothed, axis=1))
+            smoothed[flip] = smoothed[flip] * -1  # Flip to detect the trough as a peak instead
+
+        for idx in np.where(np.invert(noisy))[0]:
+            peaks, properties = scipy.signal.find_peaks(smoothed[idx], prominence=(None, 1))
+            if len(peaks) == 0:  # No peak at all, can't be a saccade
+                noisy[idx] = True
                 continue
 
-            start_mean = np.mean(sacc[:35])
-            end_mean = np.mean(sacc[-35:])
-            # pos is temporal=-1 (end - start), neg is nasal=1, other is noise
-            diff = end_mean - start_mean
-            if diff >= 0:
-                predicts.append(-1)
-            else:
-                predicts.append(1)
+            # Only one peak should be significant, and there shouldn't be a significant trough
+            max_prominence = np.max(properties["prominences"])
+            if np.count_nonzero(properties["prominences"] / max_prominence > .25) > 1:
+                noisy[idx] = True
+                continue
+
+            flipped_peaks, flipped_properties = scipy.signal.find_peaks(-1 * smoothed[idx], prominence=(None, 1))
+            if np.any(flipped_properties["prominences"] / max_prominence > .25):
+                noisy[idx] = True
 
-        noise = data[np.where(np.array(predicts) == 0)[0]]
-        pos = data[np.where(np.array(predicts) == 1)[0]]
-        neg = data[np.where(np.array(predicts) == -1)[0]]
+        return noisy
 
-        def show(arr):
-            px.line(arr.T).show()
+    def predict(self, data):
+        # data is (saccadenum, t)
+        data = np.asarray(data)
+        noisy = self.noisy_mask(data)
 
-        def debug_run(arr, num):
-            self.is_too_noisy(arr[num, :], True, True)
+        # pos is temporal=-1 (end - start), neg is nasal=1, other is noise
+        diff = np.mean(data[:, -35:], axis=1) - np.mean(data[:, :35], axis=1)
+        predicts = np.where(diff >= 0, -1, 1)
+        predicts[noisy] = 0
 
-        return np.array(predicts)[:, None]
+        return predicts[:, None]
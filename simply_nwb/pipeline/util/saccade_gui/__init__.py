@@ -1,4 +1,9 @@
+import threading
+import time
+
 import matplotlib as mpl
+from matplotlib import pylab as plt
+from matplotlib.backend_bases import FigureCanvasBase
 
 
 # Code sourced from: https://github.com/jbhunt/myphdlib/blob/7a6dd65fa410e985853027767d95010872aff505/myphdlib/extensions/matplotlib.py
@@ -15,3 +20,64 @@ def removeArrowKeyBindings():
             mpl.rcParams[f'keymap.{action}'].remove(key)
 
     return
+
+
+class WaitableGUI(object):
+    """
+    Mixin for the labeling GUIs to block until the figure is closed without busy-waiting
+    Subclasses need a self.fig and must call self.initWaiting() once the figure is created
+    """
+
+    def initWaiting(self):
+        """
+        """
+
+        self.closedEvent = threading.Event()
+        self.fig.canvas.callbacks.connect('close_event', self.onFigureClosed)
+
+        return
+
+    def onFigureClosed(self, event=None):
+        """
+        """
+
+        self.closedEvent.set()
+
+        return
+
+    def wait(self, timeout=None, interval=0.05, driver=None):
+        """
+        Block until the GUI is closed (the exit button or the window is closed). With an interactive backend the
+        figure's event loop is run while waiting, otherwise (headless) the thread sleeps on the close event
+
+        :param timeout: max time to wait in seconds, None to wait forever
+        :param interval: how often in seconds to hand control to the event loop and check if the GUI is closed
+        :param driver: optional callable driver(gui) called every interval, used to script events when headless (e.g. testing)
+        :returns: True if the GUI was closed, False if the timeout was reached
+        """
+
+        # GUI backends override start_event_loop, headless backends (Agg etc.) use the base class's sleep loop
+        interactive = type(self.fig.canvas).start_event_loop is not FigureCanvasBase.start_event_loop
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while not self.closedEvent.is_set():
+            if driver is not None:
+                driver(self)
+
+            if not plt.fignum_exists(self.fig.number):  # Closed without a close_event, e.g. plt.close() headless
+                self.closedEvent.set()
+                break
+
+            step = interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                step = min(step, remaining)
+
+            if interactive:
+                self.fig.canvas.start_event_loop(step)
+            else:
+                self.closedEvent.wait(step)
+
+        return True
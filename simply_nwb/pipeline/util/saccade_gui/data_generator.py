@@ -15,11 +15,12 @@ def mirror_waveforms(orig_wvs):
     return mirrored
 
 
-def noise_waveforms(orig_wvs):
+def noise_waveforms(orig_wvs, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
     stds = np.std(orig_wvs[:, :BASELINE_IDX_LEN], axis=1)
-    noise_wvs = np.copy(orig_wvs)
-    for idx in range(noise_wvs.shape[0]):
-        noise_wvs[idx] += np.random.normal(0, stds[idx] / 2, size=noise_wvs.shape[1])
+    # Noise std for each waveform is half of its baseline std
+    noise_wvs = orig_wvs + rng.normal(size=orig_wvs.shape) * (stds[:, None] / 2)
     return noise_wvs
 
 
@@ -29,9 +30,10 @@ def scale_waveforms(orig_wvs, scale_factor):
 
 class DirectionDataGenerator(object):
 
-    def __init__(self, waveforms, predictions):
+    def __init__(self, waveforms, predictions, seed=None):
         self.wv = waveforms  # (numsaccades, time)
         self.pred = predictions  # [[0],[1],[-1], ..etc]
+        self._rng = np.random.default_rng(seed)  # Used for the noise and the batch shuffling
 
     def _to_nearest_one(self, val):
         if val < 0:
@@ -60,7 +62,7 @@ class DirectionDataGenerator(object):
         return mirrored, mirror_pred
 
     def _noise(self, orig_wvs, orig_preds):
-        noise_wvs = noise_waveforms(orig_wvs)
+        noise_wvs = noise_waveforms(orig_wvs, self._rng)
         # import matplotlib.pyplot as plt
         # [plt.plot(f, color="orange") for f in noise_wvs]
         # [plt.plot(f, color="blue") for f in orig_wvs]
@@ -70,7 +72,7 @@ class DirectionDataGenerator(object):
     def _scaling_funcs(self, scale_factor_list):
         funcs = []
         for scale_factor in scale_factor_list:
-            def func(orig_wvs, orig_preds):
+            def func(orig_wvs, orig_preds, scale_factor=scale_factor):  # Bind the factor now, not at call time
                 wvs = scale_waveforms(orig_wvs, scale_factor)
                 preds = np.copy(orig_preds) * self._to_nearest_one(scale_factor)
                 return wvs, preds
@@ -78,8 +80,9 @@ class DirectionDataGenerator(object):
 
         return funcs
 
-    def generate(self) -> tuple[np.ndarray, np.ndarray]:
-        funcs = [
+    def _augment_funcs(self):
+        # Each func is applied to every waveform generated so far, so the data doubles with each func
+        return [
             self._flip,
             self._noise,
             self._mirror,
@@ -88,6 +91,46 @@ class DirectionDataGenerator(object):
             self._noise
         ]
 
+    def num_samples(self) -> int:
+        """
+        Total number of (augmented) samples that generate() creates and batches() iterates over
+        """
+        return self.wv.shape[0] * 2 ** len(self._augment_funcs())
+
+    def batches(self, batch_size=256, shuffle=True):
+        """
+        Iterate over the same augmented data that generate() returns, in mini-batches that are created on the fly
+        so the full augmented training set is never held in memory
+
+        Augmented sample i is the original waveform i % N with augmentation func k applied when bit k of i // N is set,
+        which matches the ordering of generate()
+
+        :param batch_size: number of samples per batch
+        :param shuffle: shuffle the samples (using the generator's seed) before batching
+        :returns: generator of (waveforms, predictions) like ((batch_size, time), (batch_size, 1))
+        """
+        funcs = self._augment_funcs()
+        num_orig = self.wv.shape[0]
+        total = self.num_samples()
+        order = self._rng.permutation(total) if shuffle else np.arange(total)
+
+        for start in range(0, total, batch_size):
+            idxs = order[start:start + batch_size]
+            sample_idxs = idxs % num_orig
+            combos = idxs // num_orig  # bitmask of which augmentation funcs to apply
+
+            wvs = self.wv[sample_idxs].astype(float)
+            preds = np.copy(self.pred[sample_idxs])
+            for bit, func in enumerate(funcs):
+                rows = ((combos >> bit) & 1) == 1
+                if np.any(rows):
+                    wvs[rows], preds[rows] = func(wvs[rows], preds[rows])
+
+            yield wvs, preds
+
+    def generate(self) -> tuple[np.ndarray, np.ndarray]:
+        funcs = self._augment_funcs()
+
         wvs = self.wv
         preds = self.pred
         for func in funcs:
@@ -114,21 +157,17 @@ class DirectionDataGenerator(object):
 
 
 class EpochDataGenerator(object):
-    def __init__(self, waveforms, epochs):
+    def __init__(self, waveforms, epochs, seed=None):
         self.wv = waveforms
         self.ep = epochs
+        self._rng = np.random.default_rng(seed)
 
     def _flip(self, orig_wvs, orig_ep):
         flip = flip_waveforms(orig_wvs)
-        flip_ep = []
-
-        for idx in range(orig_ep.shape[0]):
-            start = orig_ep[idx][0]
-            end = orig_ep[idx][1]
-            assert start < 0, "Start epoch must be negative to flip around center of saccadic window"
-            assert end > 0, "End epoch must be positive to flip around center of saccadic window"
-            flip_ep.append([end * -1, start * -1])
-        flip_ep = np.array(flip_ep)
+        orig_ep = np.asarray(orig_ep)
+        assert np.all(orig_ep[:, 0] < 0), "Start epoch must be negative to flip around center of saccadic window"
+        assert np.all(orig_ep[:, 1] > 0), "End epoch must be positive to flip around center of saccadic window"
+        flip_ep = orig_ep[:, ::-1] * -1  # [start, end] -> [-end, -start]
 
         # import matplotlib.pyplot as plt
         # [plt.plot(f) for f in orig_wvs]
@@ -149,12 +188,12 @@ class EpochDataGenerator(object):
         return mirror, orig_ep  # Mirroring doesn't change epoch ordering, mirroring over xaxis
 
     def _noise(self, orig_wvs, orig_ep):
-        return noise_waveforms(orig_wvs), orig_ep
+        return noise_waveforms(orig_wvs, self._rng), orig_ep
 
     def _scaling_funcs(self, scale_factor_list):
         funcs = []
         for scale_factor in scale_factor_list:
-            def func(orig_wvs, orig_eps):
+            def func(orig_wvs, orig_eps, scale_factor=scale_factor):  # Bind the factor now, not at call time
                 wvs = scale_waveforms(orig_wvs, scale_factor)
                 return wvs, orig_eps
             funcs.append(func)
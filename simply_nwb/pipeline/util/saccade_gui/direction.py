@@ -2,11 +2,11 @@ import numpy as np
 from matplotlib import pylab as plt
 from matplotlib import widgets as wid
 from matplotlib import lines
-from simply_nwb.pipeline.util.saccade_gui import removeArrowKeyBindings
+from simply_nwb.pipeline.util.saccade_gui import removeArrowKeyBindings, WaitableGUI
 # Code sourced from: https://github.com/jbhunt/myphdlib/blob/7a6dd65fa410e985853027767d95010872aff505/myphdlib/extensions/matplotlib.py
 
 
-class SaccadeDirectionLabelingGUI(object):
+class SaccadeDirectionLabelingGUI(WaitableGUI):
     """
     """
 
@@ -80,6 +80,7 @@ class SaccadeDirectionLabelingGUI(object):
         self.exitButton.on_clicked(self.onExitButtonClicked)
         removeArrowKeyBindings()
         self.fig.canvas.callbacks.connect('key_press_event', self.onKeyPress)
+        self.initWaiting()
 
         return
 
@@ -192,6 +193,7 @@ class SaccadeDirectionLabelingGUI(object):
         """
 
         plt.close(self.fig)
+        self.onFigureClosed()
 
         return
 
@@ -6,11 +6,11 @@ from matplotlib.backend_bases import MouseButton
 from matplotlib.colors import LinearSegmentedColormap
 import matplotlib as mpl
 
-from simply_nwb.pipeline.util.saccade_gui import removeArrowKeyBindings
+from simply_nwb.pipeline.util.saccade_gui import removeArrowKeyBindings, WaitableGUI
 # Code sourced from: https://github.com/jbhunt/myphdlib/blob/7a6dd65fa410e985853027767d95010872aff505/myphdlib/extensions/matplotlib.py
 
 
-class SaccadeEpochLabelingGUI(object):
+class SaccadeEpochLabelingGUI(WaitableGUI):
     """
     """
 
@@ -90,6 +90,7 @@ class SaccadeEpochLabelingGUI(object):
         removeArrowKeyBindings()
         self.fig.canvas.callbacks.connect('key_press_event', self.onKeyPress)
         self.fig.canvas.callbacks.connect('button_press_event', self.onButtonPress)
+        self.initWaiting()
 
     def updatePlot(self):
         """
@@ -179,6 +180,7 @@ class SaccadeEpochLabelingGUI(object):
         """
 
         plt.close(self.fig)
+        self.onFigureClosed()
 
         return
 
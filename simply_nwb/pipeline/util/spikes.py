@@ -0,0 +1,213 @@
+import numpy as np
+from hdmf.common import VectorData, VectorIndex
+from pynwb.misc import Units
+from scipy.ndimage import gaussian_filter1d
+from scipy.sparse import coo_matrix
+
+from simply_nwb.pipeline.util.chunked import chunked_dataio
+
+
+def group_spikes_by_unit(spike_clusters):
+    """
+    Group spikes by their unit without looping over the units, using a stable argsort so each unit's spikes stay in time order
+
+    :param spike_clusters: (spikes,) unit id of each spike
+    :returns: (unit_ids, order, offsets) the spike indexes of unit_ids[i] are order[offsets[i]:offsets[i + 1]]
+    """
+    spike_clusters = np.asarray(spike_clusters).ravel()
+    order = np.argsort(spike_clusters, kind="stable")
+    sorted_clusters = spike_clusters[order]
+    unit_ids = np.unique(sorted_clusters)
+    offsets = np.append(np.searchsorted(sorted_clusters, unit_ids, side="left"), sorted_clusters.size)
+    return unit_ids, order, offsets
+
+
+def peri_event_spikes(spike_times, event_times, window):
+    """
+    Find the spikes around each event using searchsorted on the (sorted) spike times, without comparing every spike to
+    every event
+
+    :param spike_times: (spikes,) sorted spike times of a single unit
+    :param event_times: (events,) times of the events to align to
+    :param window: (start, stop) relative to each event, spikes in [event + start, event + stop) are included
+    :returns: (event_indexes, relative_times) for every spike within the window of an event, a raster
+    """
+    spike_times = np.asarray(spike_times).ravel()
+    event_times = np.asarray(event_times).ravel()
+    starts = np.searchsorted(spike_times, event_times + window[0], side="left")
+    stops = np.searchsorted(spike_times, event_times + window[1], side="left")
+    counts = stops - starts
+
+    event_indexes = np.repeat(np.arange(event_times.size), counts)
+    # Index of each spike within its event, added to the start of that event's spikes
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    spike_idxs = np.repeat(starts, counts) + within
+
+    relative_times = spike_times[spike_idxs] - event_times[event_indexes]
+    return event_indexes, relative_times
+
+
+def peri_event_histogram(spike_times, event_times, window, bin_size):
+    """
+    Bin the spikes around each event
+
+    :param spike_times: (spikes,) sorted spike times of a single unit
+    :param event_times: (events,) times of the events to align to
+    :param window: (start, stop) relative to each event
+    :param bin_size: width of each bin, in the same units as the spike times
+    :returns: (events, bins) spike counts
+    """
+    num_bins = int(np.ceil((window[1] - window[0]) / bin_size - 1e-9))
+    num_events = np.asarray(event_times).size
+    event_indexes, relative_times = peri_event_spikes(spike_times, event_times, window)
+
+    bin_idxs = np.clip(np.floor((relative_times - window[0]) / bin_size).astype(np.int64), 0, num_bins - 1)
+    counts = np.bincount(event_indexes * num_bins + bin_idxs, minlength=num_events * num_bins)
+    return counts.reshape(num_events, num_bins)
+
+
+def _spike_chunks(spike_times, spike_clusters, chunk_size, transform=None):
+    # Read (and transform) the spikes in fixed-size chunks, works with memory mapped arrays
+    for i in range(0, len(spike_times), chunk_size):
+        times = np.asarray(spike_times[i:i + chunk_size]).ravel()
+        if transform is not None:
+            times = transform(times)
+        yield times, np.asarray(spike_clusters[i:i + chunk_size]).ravel()
+
+
+def binned_spike_counts(spike_times, spike_clusters, bin_size, start=None, stop=None, unit_ids=None, chunk_size=1_000_000, transform=None):
+    """
+    Count the spikes of every unit in every time bin, chunk by chunk, into a sparse (units, bins) matrix.
+    Each chunk is counted with np.bincount over a flattened (bin, unit) index, spanning only the bins in that chunk
+
+    :param spike_times: (spikes,) spike times, can be a np.memmap
+    :param spike_clusters: (spikes,) unit id of each spike, can be a np.memmap
+    :param bin_size: width of each bin, in the same units as the (transformed) spike times
+    :param start: time of the left edge of the first bin, defaults to the first spike
+    :param stop: time the last bin must include, defaults to the last spike
+    :param unit_ids: sorted unit ids for the rows of the matrix, defaults to every unit in spike_clusters
+    :param chunk_size: number of spikes to read at a time
+    :param transform: Optional func(times_chunk) -> times_chunk to apply to the spike times (e.g. alignment) as they are read
+    :returns: (counts, unit_ids) where counts is a scipy.sparse.csr_matrix of shape (units, bins)
+    """
+    if unit_ids is None or start is None or stop is None:
+        # Extra pass over the spikes to find the unspecified bounds
+        found_units = []
+        found_start = np.inf
+        found_stop = -np.inf
+        for times, clusters in _spike_chunks(spike_times, spike_clusters, chunk_size, transform):
+            found_units.append(np.unique(clusters))
+            found_start = min(found_start, times.min())
+            found_stop = max(found_stop, times.max())
+        unit_ids = np.unique(np.concatenate(found_units)) if unit_ids is None else unit_ids
+        start = found_start if start is None else start
+        stop = found_stop if stop is None else stop
+
+    unit_ids = np.asarray(unit_ids)
+    num_units = len(unit_ids)
+    num_bins = int(np.floor((stop - start) / bin_size)) + 1
+
+    rows = []
+    cols = []
+    vals = []
+    for times, clusters in _spike_chunks(spike_times, spike_clusters, chunk_size, transform):
+        unit_idxs = np.searchsorted(unit_ids, clusters)
+        bin_idxs = np.floor((times - start) / bin_size).astype(np.int64)
+        keep = (unit_idxs < num_units) & (bin_idxs >= 0) & (bin_idxs < num_bins)
+        keep[keep] = unit_ids[unit_idxs[keep]] == clusters[keep]  # Drop units that weren't asked for
+        if not np.any(keep):
+            continue
+
+        flat = bin_idxs[keep] * num_units + unit_idxs[keep]
+        lowest = flat.min()
+        span = flat.max() - lowest + 1
+        if span <= 16 * flat.size + num_units:
+            counts = np.bincount(flat - lowest, minlength=span)
+            nonzero = np.nonzero(counts)[0]
+            flat_idxs = nonzero + lowest
+            counts = counts[nonzero]
+        else:
+            # Spikes in this chunk aren't in time order, avoid a huge dense bincount
+            flat_idxs, counts = np.unique(flat, return_counts=True)
+
+        rows.append(flat_idxs % num_units)
+        cols.append(flat_idxs // num_units)
+        vals.append(counts)
+
+    if rows:
+        rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    else:
+        rows, cols, vals = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Duplicate entries (bins split across chunks) are summed by the conversion
+    counts = coo_matrix((vals.astype(np.int32), (rows, cols)), shape=(num_units, num_bins)).tocsr()
+    return counts, unit_ids
+
+
+def firing_rates_from_counts(counts, bin_size, rows=None, sigma=None):
+    """
+    Convert (sparse) binned spike counts into dense firing rates, optionally smoothed with a gaussian
+
+    :param counts: (units, bins) scipy.sparse matrix or array of spike counts
+    :param bin_size: width of each bin in seconds
+    :param rows: Optional rows (units) to convert, to avoid making the whole matrix dense, defaults to all rows
+    :param sigma: Optional gaussian smoothing standard deviation, in seconds
+    :returns: (units, bins) float array of firing rates in spikes/second
+    """
+    if rows is not None:
+        counts = counts[rows]
+    if hasattr(counts, "toarray"):
+        counts = counts.toarray()
+    rates = np.asarray(counts, dtype=np.float64) / bin_size
+
+    if sigma is not None:
+        rates = gaussian_filter1d(rates, sigma / bin_size, axis=1, mode="constant")
+    return rates
+
+
+class _UnitOrderedSpikes(object):
+    """
+    Read-only view of the spike times in unit order, spike_times[order[item]], so a memory mapped array can be
+    written unit by unit without copying all of it into memory
+    """
+    def __init__(self, spike_times, order):
+        self.spike_times = spike_times
+        self.order = order
+        self.shape = (len(order),)
+        self.dtype = spike_times.dtype
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            item = item[0]
+        # Each unit's spikes are in time order, so the memmap is read in increasing order within a unit
+        return np.asarray(self.spike_times[self.order[item]]).reshape(np.shape(self.order[item]))
+
+
+def units_table_from_spikes(spike_times, spike_clusters, description="Spike sorted units", transform=None, chunk_size=None):
+    """
+    Build an NWB Units table with a ragged spike_times column in one shot, instead of an add_unit call for each unit
+
+    :param spike_times: (spikes,) spike times in seconds, can be a np.memmap
+    :param spike_clusters: (spikes,) unit id of each spike
+    :param description: description of the units table
+    :param transform: Optional func(times_chunk) -> times_chunk to apply to the spike times (e.g. alignment) as they are read
+    :param chunk_size: Optional number of spikes to read at a time, if set the spike times are read from spike_times
+        unit by unit as the NWB is written instead of being copied into memory
+    :returns: pynwb.misc.Units to set as nwbfile.units, spikes of row i are spike_times[spike_times_index[i - 1]:spike_times_index[i]]
+    """
+    unit_ids, order, offsets = group_spikes_by_unit(spike_clusters)
+
+    if chunk_size is None:
+        times = np.asarray(spike_times).ravel()[order]
+        if transform is not None:
+            times = transform(times)
+    else:
+        times = chunked_dataio(_UnitOrderedSpikes(spike_times, order), chunk_size, transform=transform, dtype=np.float64)
+
+    times_col = VectorData(name="spike_times", data=times, description="the spike times for each unit in seconds")
+    times_index = VectorIndex(name="spike_times_index", data=offsets[1:], target=times_col)
+    # Index before its target, hdmf drops iterator columns from its length check before looking for their index
+    return Units(name="units", description=description, id=unit_ids, columns=[times_index, times_col])
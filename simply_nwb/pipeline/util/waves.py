@@ -89,3 +89,32 @@ def startstop_of_squarewave(arr: np.ndarray, minval=None, maxval=None, epsilon=.
     # px.line(tmp).show()
 
     return result
+
+
+def signal_transitions(arr: np.ndarray) -> np.ndarray:
+    """
+    Compress a signal that only changes value occasionally (e.g. a digital square wave) into its transitions
+
+    :param arr: Array of the signal (samples,)
+    :returns: np.ndarray of shape (num segments, 2) of [start index, value] for each run of a constant value,
+        the first row is the initial state
+    """
+    arr = np.asarray(arr).ravel()
+    if arr.size == 0:
+        return np.zeros((0, 2))
+    starts = np.concatenate([[0], np.where(np.diff(arr) != 0)[0] + 1])
+    return np.stack([starts, arr[starts]], axis=1)
+
+
+def signal_from_transitions(transitions: np.ndarray, num_samples: int) -> np.ndarray:
+    """
+    Rebuild the dense signal from the output of signal_transitions
+
+    :param transitions: (num segments, 2) of [start index, value]
+    :param num_samples: Length of the original signal
+    :returns: np.ndarray of the signal (samples,)
+    """
+    transitions = np.asarray(transitions)
+    starts = transitions[:, 0].astype(np.int64)
+    lengths = np.diff(np.append(starts, num_samples))
+    return np.repeat(transitions[:, 1], lengths)
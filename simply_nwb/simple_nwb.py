@@ -18,9 +18,10 @@ from simply_nwb.transforms.labjack import _LabjackMixin
 from simply_nwb.transforms.blackrock import _BlackrockMixin
 from simply_nwb.transforms.p_erg import _PergMixin
 from simply_nwb.transforms.eyetracking import _EyetrackingMixin
+from simply_nwb.transforms.neuropixels import _NeuropixelsMixin
 
 
-class SimpleNWB(_TIFMixin, _MP4Mixin, _LabjackMixin, _BlackrockMixin, _PergMixin, _EyetrackingMixin, object):
+class SimpleNWB(_TIFMixin, _MP4Mixin, _LabjackMixin, _BlackrockMixin, _PergMixin, _EyetrackingMixin, _NeuropixelsMixin, object):
     @staticmethod
     def create_nwb(
             session_description: str,
@@ -1,11 +1,20 @@
 # Code adapted from https://github.com/denmanlab/dlab/blob/master/nwbtools.py
 import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Optional, Union
 import pandas as pd
 import numpy as np
 import os
 import csv
+import time
+import warnings
 from scipy.io import loadmat
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import GenericDataChunkIterator
+from pynwb import NWBFile
+from hdmf.common import DynamicTableRegion
+from pynwb.ecephys import ElectricalSeries, LFP
+from scipy.signal import butter, sosfiltfilt
 
 
 _option234_positions = np.zeros((384, 2))
@@ -17,6 +26,501 @@ _option234_positions[:, 1] = np.floor(np.linspace(383, 0, 384) / 2) * 20
 
 OPTION234_POSITIONS = _option234_positions
 
+_trapezoid = np.trapezoid if hasattr(np, "trapezoid") else np.trapz  # np.trapz was renamed in numpy 2.0
+
+
+def _full_width_shapes(kwargs: dict, maxshape: tuple[int, int], row_bytes: int) -> dict:
+    """
+    Default the chunk and buffer shapes of a GenericDataChunkIterator over (samples, channels) data to span every
+    channel, so each buffer is one contiguous read of the interleaved file instead of a column slice of all of it
+
+    :param kwargs: kwargs for GenericDataChunkIterator, chunk_shape/buffer_shape given are kept, chunk_mb/buffer_gb
+        are used to size the defaults
+    :param maxshape: (samples, channels) shape of the output
+    :param row_bytes: Bytes of memory used to produce one output sample (row), used to size the buffer
+    :return: kwargs with chunk_shape and buffer_shape set
+    """
+    kwargs = dict(kwargs)
+    num_samples, num_channels = maxshape
+    if "chunk_shape" not in kwargs:
+        chunk_mb = kwargs.pop("chunk_mb", None) or 10.
+        rows = int(chunk_mb * 1e6 // (num_channels * 2))  # Output is int16
+        kwargs["chunk_shape"] = (min(max(1, rows), num_samples), num_channels)
+    if "buffer_shape" not in kwargs:
+        buffer_gb = kwargs.pop("buffer_gb", None) or 1.
+        chunk_rows = kwargs["chunk_shape"][0]
+        rows = int(buffer_gb * 1e9 // row_bytes) // chunk_rows * chunk_rows  # Must be a multiple of the chunks
+        kwargs["buffer_shape"] = (min(max(chunk_rows, rows), num_samples), num_channels)
+    return kwargs
+
+
+class ContinuousDatChunkIterator(GenericDataChunkIterator):
+    """
+    Iterate over a raw int16 continuous.dat file (samples, channels) in chunks, only one buffer is read into memory at a time
+    """
+    def __init__(self, filename: str, num_channels: int = 384, **kwargs):
+        """
+        :param filename: Path to the continuous.dat file
+        :param num_channels: Number of channels interleaved in the file
+        :param kwargs: extra kwargs for GenericDataChunkIterator, like chunk_shape, buffer_shape or buffer_gb. Chunks
+            and buffers default to spanning every channel
+        """
+        self.filename = filename
+        self.num_channels = num_channels
+        self._data = np.memmap(filename, dtype=np.int16, mode='r').reshape(-1, num_channels)
+        super().__init__(**_full_width_shapes(kwargs, self._data.shape, num_channels * self._data.itemsize))
+
+    def _get_data(self, selection):
+        return np.asarray(self._data[selection])
+
+    def _get_maxshape(self):
+        return self._data.shape
+
+    def _get_dtype(self):
+        return self._data.dtype
+
+
+class ContinuousDatPreprocessor(object):
+    """
+    Chunked preprocessing of a raw int16 continuous.dat file (samples, channels): common median/average referencing
+    across channels, then zero-phase Butterworth filtering (band-pass, low-pass or high-pass) of each channel.
+    Blocks are read with overlapping padding on both sides and cropped after filtering, so the output matches
+    processing the whole recording. The channels of a block are filtered in a thread pool, except in to_dat where
+    the blocks themselves are processed in parallel
+    """
+    REFERENCES = [None, "median", "average"]
+
+    def __init__(self, filename: str, num_channels: int = 384, sampling_rate: float = 30000.,
+                 reference: Optional[str] = "median", band: Optional[tuple[Optional[float], Optional[float]]] = (300., 6000.),
+                 filter_order: int = 3, pad_samples: Optional[int] = None, workers: Optional[int] = None):
+        """
+        :param filename: Path to the continuous.dat file
+        :param num_channels: Number of channels interleaved in the file
+        :param sampling_rate: Sampling rate of the raw data
+        :param reference: 'median' or 'average' to subtract the median/mean across channels from each sample, None to skip
+        :param band: (low, high) cutoffs in Hz, use None for low to low-pass, None for high to high-pass, or None to skip filtering
+        :param filter_order: Order of the Butterworth filter
+        :param pad_samples: Raw samples of overlap read on each side of a block, defaults to 50ms
+        :param workers: Number of threads to use, None for number of cpus
+        """
+        if reference not in ContinuousDatPreprocessor.REFERENCES:
+            raise ValueError(f"Unknown reference '{reference}'! Must be one of '{ContinuousDatPreprocessor.REFERENCES}'")
+
+        self.filename = filename
+        self.num_channels = num_channels
+        self.sampling_rate = sampling_rate
+        self.reference = reference
+        self.band = band
+        self.pad_samples = int(0.05 * sampling_rate) if pad_samples is None else pad_samples
+        self.workers = workers or os.cpu_count() or 1
+        self.data = np.memmap(filename, dtype=np.int16, mode='r').reshape(-1, num_channels)
+
+        self.sos = None
+        if band is not None:
+            low, high = band
+            if low is not None and high is not None:
+                self.sos = butter(filter_order, [low, high], btype='bandpass', fs=sampling_rate, output='sos')
+            elif high is not None:
+                self.sos = butter(filter_order, high, btype='lowpass', fs=sampling_rate, output='sos')
+            elif low is not None:
+                self.sos = butter(filter_order, low, btype='highpass', fs=sampling_rate, output='sos')
+
+    @property
+    def num_samples(self) -> int:
+        return self.data.shape[0]
+
+    def _filter_channels(self, block, parallel=True):
+        # Filter the columns of the block in a thread pool, scipy releases the GIL while filtering
+        if not parallel or self.workers == 1:
+            return sosfiltfilt(self.sos, block, axis=0).astype(block.dtype, copy=False)
+
+        groups = np.array_split(np.arange(block.shape[1]), min(block.shape[1], self.workers))
+        filtered = np.empty_like(block)
+
+        def filter_group(channels):
+            filtered[:, channels] = sosfiltfilt(self.sos, block[:, channels], axis=0)
+
+        with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+            list(pool.map(filter_group, groups))
+        return filtered
+
+    def process_block(self, start: int, stop: int, channels=slice(None)) -> np.ndarray:
+        """
+        Preprocess raw samples [start, stop)
+
+        :param start: First raw sample
+        :param stop: Raw sample to stop at (exclusive)
+        :param channels: Channels to return, referencing always uses every channel
+        :return: float32 array of shape (stop - start, channels)
+        """
+        return self._process_block(start, stop, channels)
+
+    def _process_block(self, start, stop, channels=slice(None), parallel=True):
+        read_start = max(0, start - self.pad_samples)
+        read_stop = min(self.num_samples, stop + self.pad_samples)
+        if self.reference is None:
+            # Only convert the channels that are returned, referencing is what needs every channel
+            block = self.data[read_start:read_stop, channels].astype(np.float32)
+        else:
+            block = self.data[read_start:read_stop].astype(np.float32)
+            if self.reference == "median":
+                block -= np.median(block, axis=1, keepdims=True)
+            elif self.reference == "average":
+                block -= np.mean(block, axis=1, keepdims=True)
+            block = block[:, channels]
+
+        if self.sos is not None:
+            block = self._filter_channels(block, parallel)
+        return block[start - read_start:stop - read_start]
+
+    def to_dat(self, output_filename: str, block_samples: int = 30000) -> float:
+        """
+        Preprocess the whole file into a new int16 .dat file, blocks are processed in parallel
+
+        :param output_filename: Path to the output .dat file
+        :param block_samples: Number of raw samples per block
+        :return: Throughput in MB/s of raw data processed
+        """
+        output = np.memmap(output_filename, dtype=np.int16, mode='w+', shape=self.data.shape)
+        starts = range(0, self.num_samples, block_samples)
+
+        def process(start):
+            stop = min(start + block_samples, self.num_samples)
+            output[start:stop] = _to_int16(self._process_block(start, stop, parallel=False))
+
+        start_time = time.perf_counter()
+        # Blocks are independent because of the overlap, so each thread filters a whole block's channels serially
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(process, starts))
+        output.flush()
+
+        elapsed = time.perf_counter() - start_time
+        megabytes = self.data.nbytes / 1e6
+        throughput = megabytes / elapsed if elapsed > 0 else float('inf')
+        print(f"Preprocessed {megabytes:.1f}MB in {elapsed:.1f}s ({throughput:.1f}MB/s) into '{output_filename}'")
+        return throughput
+
+    def iterator(self, **kwargs) -> "PreprocessedChunkIterator":
+        """
+        Get a chunk iterator of the preprocessed data for writing into an NWB
+
+        :param kwargs: extra kwargs for GenericDataChunkIterator, like chunk_shape, buffer_shape or buffer_gb
+        """
+        return PreprocessedChunkIterator(self, **kwargs)
+
+
+def _to_int16(arr: np.ndarray) -> np.ndarray:
+    return np.clip(np.rint(arr), np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype(np.int16)
+
+
+class PreprocessedChunkIterator(GenericDataChunkIterator):
+    """
+    Iterate over the output of a ContinuousDatPreprocessor in chunks, optionally decimated
+    """
+    def __init__(self, preprocessor: ContinuousDatPreprocessor, factor: int = 1, **kwargs):
+        """
+        :param preprocessor: ContinuousDatPreprocessor to read the data from
+        :param factor: Decimation factor, keeps every factor-th sample, the preprocessor should low-pass the data first
+        :param kwargs: extra kwargs for GenericDataChunkIterator, like chunk_shape, buffer_shape or buffer_gb. Chunks
+            and buffers default to spanning every channel, so each block is read and referenced once, with buffer_gb
+            bounding the float64 raw samples behind each buffer
+        """
+        self.preprocessor = preprocessor
+        self.factor = factor
+        self.rate = preprocessor.sampling_rate / factor
+        # Each output sample needs factor raw samples of every channel, filtered as float64
+        row_bytes = factor * preprocessor.num_channels * np.dtype(np.float64).itemsize
+        super().__init__(**_full_width_shapes(kwargs, self._get_maxshape(), row_bytes))
+
+    def _get_data(self, selection):
+        sample_selection, channel_selection = selection
+        raw_start = sample_selection.start * self.factor
+        raw_stop = min(self.preprocessor.num_samples, (sample_selection.stop - 1) * self.factor + 1)
+        block = self.preprocessor.process_block(raw_start, raw_stop, channel_selection)
+        return _to_int16(block[::self.factor])
+
+    def _get_maxshape(self):
+        return (self.preprocessor.num_samples + self.factor - 1) // self.factor, self.preprocessor.num_channels
+
+    def _get_dtype(self):
+        return np.dtype(np.int16)
+
+
+class LFPChunkIterator(PreprocessedChunkIterator):
+    """
+    Low-pass filter and decimate a raw int16 continuous.dat file (samples, channels) into the LFP band, in chunks
+    using a ContinuousDatPreprocessor without referencing
+    """
+    def __init__(self, filename: str, num_channels: int = 384, sampling_rate: float = 30000., lfp_rate: float = 2500.,
+                 cutoff: float = 1000., filter_order: int = 8, pad_samples: Optional[int] = None,
+                 workers: Optional[int] = None, **kwargs):
+        """
+        :param filename: Path to the continuous.dat file
+        :param num_channels: Number of channels interleaved in the file
+        :param sampling_rate: Sampling rate of the raw data
+        :param lfp_rate: Approximate sampling rate of the output, the raw data is decimated by round(sampling_rate / lfp_rate)
+        :param cutoff: Low-pass cutoff frequency in Hz, must be below half of the output rate
+        :param filter_order: Order of the Butterworth low-pass filter
+        :param pad_samples: Raw samples of overlap read on each side of a chunk, defaults to 50ms
+        :param workers: Number of threads to filter the channels with, None for number of cpus
+        :param kwargs: extra kwargs for GenericDataChunkIterator, like chunk_shape, buffer_shape or buffer_gb
+        """
+        factor = int(round(sampling_rate / lfp_rate))
+        if cutoff >= sampling_rate / factor / 2:
+            raise ValueError(f"Cutoff '{cutoff}' must be below the Nyquist frequency '{sampling_rate / factor / 2}' of the decimated data!")
+        preprocessor = ContinuousDatPreprocessor(filename, num_channels=num_channels, sampling_rate=sampling_rate,
+                                                 reference=None, band=(None, cutoff), filter_order=filter_order,
+                                                 pad_samples=pad_samples, workers=workers)
+        super().__init__(preprocessor, factor=factor, **kwargs)
+
+
+class _NeuropixelsMixin(object):
+    @staticmethod
+    def neuropixels_add_probe_electrodes(
+            nwbfile: NWBFile,
+            device_name: str = "Neuropixels probe",
+            electrode_group_name: str = "probe",
+            electrode_location: str = "unknown",
+            site_positions: Optional[np.ndarray] = None
+    ) -> DynamicTableRegion:
+        """
+        Add a neuropixels probe's device, electrode group and electrodes to the NWB
+
+        :param nwbfile: NWBFile to add the electrodes to
+        :param device_name: Name of the device to create for the probe
+        :param electrode_group_name: Name of the electrode group to create for the probe
+        :param electrode_location: Location of the probe in the brain
+        :param site_positions: Positions of the channels on the probe (channels, 2), defaults to OPTION234_POSITIONS
+        :return: DynamicTableRegion of the probe's electrodes, to use for an ElectricalSeries
+        """
+        if site_positions is None:
+            site_positions = OPTION234_POSITIONS
+
+        device = nwbfile.create_device(name=device_name, description="Neuropixels probe", manufacturer="IMEC")
+        electrode_group = nwbfile.create_electrode_group(
+            name=electrode_group_name,
+            description=f"Electrodes of {device_name}",
+            location=electrode_location,
+            device=device
+        )
+
+        first_electrode = 0 if nwbfile.electrodes is None else len(nwbfile.electrodes)
+        for channel in range(site_positions.shape[0]):
+            nwbfile.add_electrode(
+                group=electrode_group,
+                location=electrode_location,
+                rel_x=float(site_positions[channel, 0]),
+                rel_y=float(site_positions[channel, 1])
+            )
+        return nwbfile.create_electrode_table_region(
+            region=list(range(first_electrode, first_electrode + site_positions.shape[0])),
+            description=f"Electrodes of {device_name}"
+        )
+
+    @staticmethod
+    def neuropixels_lfp_as_processing(
+            nwbfile: NWBFile,
+            continuous_dat_filename: str,
+            name: str = "LFP",
+            description: str = "Low-pass filtered and decimated neuropixels data",
+            electrodes: Optional[DynamicTableRegion] = None,
+            device_name: str = "Neuropixels probe",
+            electrode_group_name: str = "probe",
+            electrode_location: str = "unknown",
+            sampling_rate: float = 30000.,
+            lfp_rate: float = 2500.,
+            cutoff: float = 1000.,
+            num_channels: int = 384,
+            conversion: float = 0.195e-6,
+            starting_time: float = 0.0,
+            site_positions: Optional[np.ndarray] = None,
+            workers: Optional[int] = None,
+            chunk_shape: Optional[tuple[int, int]] = None,
+            buffer_shape: Optional[tuple[int, int]] = None,
+            compression: str = "gzip"
+    ) -> NWBFile:
+        """
+        Stream the LFP band of a raw neuropixels continuous.dat into the 'ecephys' processing module as an LFP
+        ElectricalSeries. The data is filtered and decimated one buffer at a time when the NWB is written, see LFPChunkIterator
+
+        :param nwbfile: NWBFile to add the data to
+        :param continuous_dat_filename: Path to the int16 continuous.dat file
+        :param name: Name of the LFP ElectricalSeries
+        :param description: Description of the ElectricalSeries
+        :param electrodes: Optional electrode table region of the probe, e.g. from neuropixels_continuous_as_acquisition,
+            if not provided the probe's electrodes will be created
+        :param device_name: Name of the device to create for the probe, if electrodes is not provided
+        :param electrode_group_name: Name of the electrode group to create for the probe, if electrodes is not provided
+        :param electrode_location: Location of the probe in the brain, if electrodes is not provided
+        :param sampling_rate: Sampling rate of the raw data, defaults to 30kHz
+        :param lfp_rate: Approximate sampling rate of the LFP, defaults to 2.5kHz
+        :param cutoff: Low-pass cutoff frequency in Hz, defaults to 1kHz
+        :param num_channels: Number of channels in the file, defaults to 384
+        :param conversion: Multiplier to convert the int16 values into volts, defaults to 0.195 uV
+        :param starting_time: Starting time of the data, relative to the session start. Defaults to 0.0
+        :param site_positions: Positions of the channels on the probe (channels, 2), defaults to OPTION234_POSITIONS
+        :param workers: Number of threads to filter the channels with, None for number of cpus
+        :param chunk_shape: Optional (samples, channels) shape of the HDF5 chunks
+        :param buffer_shape: Optional (samples, channels) shape of the data processed at a time, must be a multiple of chunk_shape
+        :param compression: HDF5 compression to use, defaults to gzip
+        :return: NWBFile
+        """
+        if electrodes is None:
+            if site_positions is None:
+                site_positions = OPTION234_POSITIONS
+            if site_positions.shape[0] != num_channels:
+                raise ValueError(f"Number of site positions '{site_positions.shape[0]}' doesn't match the number of channels '{num_channels}'!")
+
+        iterator_kwargs = {}
+        if chunk_shape is not None:
+            iterator_kwargs["chunk_shape"] = chunk_shape
+        if buffer_shape is not None:
+            iterator_kwargs["buffer_shape"] = buffer_shape
+        data = LFPChunkIterator(continuous_dat_filename, num_channels=num_channels, sampling_rate=sampling_rate,
+                                lfp_rate=lfp_rate, cutoff=cutoff, workers=workers, **iterator_kwargs)
+
+        if electrodes is None:
+            electrodes = _NeuropixelsMixin.neuropixels_add_probe_electrodes(nwbfile, device_name, electrode_group_name, electrode_location, site_positions)
+
+        series = ElectricalSeries(
+            name=name,
+            description=description,
+            data=H5DataIO(data=data, compression=compression),
+            electrodes=electrodes,
+            starting_time=starting_time,
+            rate=data.rate,
+            conversion=conversion,
+            filtering=f"Zero-phase Butterworth low-pass at {cutoff}Hz, decimated by {data.factor}"
+        )
+
+        if "ecephys" in nwbfile.processing:
+            module = nwbfile.processing["ecephys"]
+        else:
+            module = nwbfile.create_processing_module(name="ecephys", description="Processed extracellular electrophysiology data")
+        module.add(LFP(electrical_series=series))
+        return nwbfile
+
+    @staticmethod
+    def neuropixels_add_mean_waveforms(
+            nwbfile: NWBFile,
+            continuous_dat_filename: str,
+            spike_samples: np.ndarray,
+            spike_clusters: np.ndarray,
+            num_channels: int = 384,
+            conversion: float = 0.195e-6,
+            samples_before: int = 41,
+            samples_after: int = 41,
+            max_spikes: int = 500,
+            seed: Optional[int] = 0
+    ) -> NWBFile:
+        """
+        Add the mean waveform of each unit in nwbfile.units, extracted from the raw continuous.dat, as the 'waveform_mean'
+        column (units, time, channels) in volts. See mean_waveforms_from_continuous
+
+        :param nwbfile: NWBFile with a units table, unit ids must be the cluster ids
+        :param continuous_dat_filename: Path to the int16 continuous.dat file
+        :param spike_samples: Sample index of each spike in the continuous.dat, e.g. spike_times.npy
+        :param spike_clusters: Cluster id of each spike
+        :param num_channels: Number of channels in the file, defaults to 384
+        :param conversion: Multiplier to convert the int16 values into volts, defaults to 0.195 uV
+        :param samples_before: Number of samples before the spike in the waveform
+        :param samples_after: Number of samples after the spike in the waveform
+        :param max_spikes: Max number of spikes per unit to average
+        :param seed: Seed for sampling the spikes
+        :return: NWBFile
+        """
+        if nwbfile.units is None:
+            raise ValueError("NWB must have a units table to add the mean waveforms to!")
+
+        cluster_ids, mean_waveforms, _ = mean_waveforms_from_continuous(
+            continuous_dat_filename, spike_samples, spike_clusters, num_channels=num_channels,
+            samples_before=samples_before, samples_after=samples_after, max_spikes=max_spikes, seed=seed
+        )
+
+        # Rows of the units table in the order of its ids, units without spikes get NaN
+        unit_ids = np.asarray(nwbfile.units.id[:])
+        found = np.isin(unit_ids, cluster_ids)
+        waveforms = np.full((len(unit_ids), *mean_waveforms.shape[1:]), np.nan, dtype=np.float32)
+        waveforms[found] = mean_waveforms[np.searchsorted(cluster_ids, unit_ids[found])] * conversion
+
+        nwbfile.units.add_column(
+            name="waveform_mean",
+            description=f"Mean waveform (time, channels) in volts from the raw data of up to {max_spikes} spikes per unit",
+            data=waveforms
+        )
+        return nwbfile
+
+    @staticmethod
+    def neuropixels_continuous_as_acquisition(
+            nwbfile: NWBFile,
+            continuous_dat_filename: str,
+            name: str = "ElectricalSeries",
+            description: str = "Raw neuropixels AP band data",
+            device_name: str = "Neuropixels probe",
+            electrode_group_name: str = "probe",
+            electrode_location: str = "unknown",
+            sampling_rate: float = 30000.,
+            num_channels: int = 384,
+            conversion: float = 0.195e-6,
+            starting_time: float = 0.0,
+            site_positions: Optional[np.ndarray] = None,
+            chunk_shape: Optional[tuple[int, int]] = None,
+            buffer_shape: Optional[tuple[int, int]] = None,
+            compression: str = "gzip",
+            preprocessor: Optional[ContinuousDatPreprocessor] = None
+    ) -> NWBFile:
+        """
+        Stream a raw neuropixels continuous.dat file into the NWB as an ElectricalSeries, along with the probe's
+        electrodes. The data is read and compressed one buffer at a time when the NWB is written
+
+        :param nwbfile: NWBFile to add the data to
+        :param continuous_dat_filename: Path to the int16 continuous.dat file
+        :param name: Name of the ElectricalSeries
+        :param description: Description of the ElectricalSeries
+        :param device_name: Name of the device to create for the probe
+        :param electrode_group_name: Name of the electrode group to create for the probe
+        :param electrode_location: Location of the probe in the brain
+        :param sampling_rate: Sampling rate of the data, defaults to 30kHz (AP band)
+        :param num_channels: Number of channels in the file, defaults to 384
+        :param conversion: Multiplier to convert the int16 values into volts, defaults to 0.195 uV
+        :param starting_time: Starting time of the data, relative to the session start. Defaults to 0.0
+        :param site_positions: Positions of the channels on the probe (channels, 2), defaults to OPTION234_POSITIONS
+        :param chunk_shape: Optional (samples, channels) shape of the HDF5 chunks
+        :param buffer_shape: Optional (samples, channels) shape of the data read into memory at a time, must be a
+            multiple of chunk_shape
+        :param compression: HDF5 compression to use, defaults to gzip
+        :param preprocessor: Optional ContinuousDatPreprocessor of the file, to write referenced/filtered data instead of the raw data
+        :return: NWBFile
+        """
+        if site_positions is None:
+            site_positions = OPTION234_POSITIONS
+        if site_positions.shape[0] != num_channels:
+            raise ValueError(f"Number of site positions '{site_positions.shape[0]}' doesn't match the number of channels '{num_channels}'!")
+
+        iterator_kwargs = {}
+        if chunk_shape is not None:
+            iterator_kwargs["chunk_shape"] = chunk_shape
+        if buffer_shape is not None:
+            iterator_kwargs["buffer_shape"] = buffer_shape
+        if preprocessor is not None:
+            data = preprocessor.iterator(**iterator_kwargs)
+        else:
+            data = ContinuousDatChunkIterator(continuous_dat_filename, num_channels=num_channels, **iterator_kwargs)
+
+        electrodes = _NeuropixelsMixin.neuropixels_add_probe_electrodes(nwbfile, device_name, electrode_group_name, electrode_location, site_positions)
+
+        series = ElectricalSeries(
+            name=name,
+            description=description,
+            data=H5DataIO(data=data, compression=compression),
+            electrodes=electrodes,
+            starting_time=starting_time,
+            rate=sampling_rate,
+            conversion=conversion
+        )
+        nwbfile.add_acquisition(series)
+        return nwbfile
+
 
 def get_peak_waveform_from_template(template: np.ndarray) -> np.ndarray:
     """
@@ -26,15 +530,185 @@ def get_peak_waveform_from_template(template: np.ndarray) -> np.ndarray:
     :return: Numpy array of the waveform
     """
 
-    tmpl_max = 0
-    ind = 0
-    peak = np.zeros(np.shape(template.T)[0])
-    for i, wv in enumerate(template.T):
-        if np.max(np.abs(wv)) > tmpl_max:
-            tmpl_max = np.max(np.abs(wv))
-            ind = i
-            peak = wv
-    return peak
+    return template_features(np.asarray(template)[None])['peak_waveform'][0]
+
+
+def template_features(templates: np.ndarray, site_positions: Optional[np.ndarray] = None, samplingrate: float = 30000.,
+                      weight_threshold: float = 0.25) -> dict:
+    """
+    Compute the waveform features of every unit at once from their mean templates
+
+    :param templates: Mean templates of shape (units, time, channels)
+    :param site_positions: Positions of the channels on the probe (channels, 2), defaults to OPTION234_POSITIONS
+    :param samplingrate: Rate at which the Neuropixels probe sampled the data, defaults to 30kHz
+    :param weight_threshold: Normalized channel weights below this are set to 0 for the position average
+
+    :return: A dictionary with keys
+        peak_channel: (units,) channel with the largest absolute value
+        peak_waveform: (units, time) waveform on the peak channel
+        waveform_weights: (units, channels, 2) normalized weight of each channel, used to average the site_positions
+        xpos: (units,) x position on the probe, weighted average of the site_positions
+        ypos: (units,) y position on the probe, weighted average of the site_positions
+        amplitude: (units,) peak to peak amplitude of the peak waveform
+        trough_to_peak: (units,) time in seconds from the trough of the peak waveform to the following peak
+    """
+    if site_positions is None:
+        site_positions = OPTION234_POSITIONS
+
+    templates = np.asarray(templates)
+    num_units, num_time, num_channels = templates.shape
+    abs_templates = np.abs(templates)
+    unit_idxs = np.arange(num_units)
+
+    peak_channel = np.argmax(abs_templates.max(axis=1), axis=1)
+    peak_waveform = templates[unit_idxs, :, peak_channel]
+
+    # Weight of each channel is the area under the absolute value of the template for that channel
+    channel_weights = np.zeros((num_units, site_positions.shape[0]))
+    channel_weights[:, :num_channels] = _trapezoid(abs_templates, axis=1)
+    max_weights = channel_weights.max(axis=1, keepdims=True)
+    channel_weights = np.divide(channel_weights, max_weights, out=np.zeros_like(channel_weights), where=max_weights > 0)
+    channel_weights[channel_weights < weight_threshold] = 0  # Where values are low, make the weight 0
+    xpos, ypos = (channel_weights @ site_positions / channel_weights.sum(axis=1, keepdims=True)).T
+    waveform_weights = np.repeat(channel_weights[:, :, None], site_positions.shape[1], axis=2)
+
+    amplitude = peak_waveform.max(axis=1) - peak_waveform.min(axis=1)
+    trough = np.argmin(peak_waveform, axis=1)
+    after_trough = np.where(np.arange(num_time)[None, :] >= trough[:, None], peak_waveform, -np.inf)
+    trough_to_peak = (np.argmax(after_trough, axis=1) - trough) / samplingrate
+
+    return {
+        'peak_channel': peak_channel,
+        'peak_waveform': peak_waveform,
+        'waveform_weights': waveform_weights,
+        'xpos': xpos,
+        'ypos': ypos,
+        'amplitude': amplitude,
+        'trough_to_peak': trough_to_peak
+    }
+
+
+def group_spikes_by_cluster(spike_clusters: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Group spikes by cluster with a stable argsort, so each cluster's spikes are a contiguous slice and stay in time order
+
+    :param spike_clusters: Cluster id of each spike
+    :return: (cluster_ids, order, offsets) the spike indexes of cluster_ids[i] are order[offsets[i]:offsets[i + 1]]
+    """
+    spike_clusters = np.asarray(spike_clusters).flatten()
+    order = np.argsort(spike_clusters, kind="stable")
+    sorted_clusters = spike_clusters[order]
+    cluster_ids = np.unique(sorted_clusters)
+    offsets = np.append(np.searchsorted(sorted_clusters, cluster_ids, side="left"), sorted_clusters.size)
+    return cluster_ids, order, offsets
+
+
+def cluster_spike_slice(cluster_ids: np.ndarray, offsets: np.ndarray, unit: int) -> slice:
+    """
+    Get the slice of a cluster's spikes into arrays sorted with the order from group_spikes_by_cluster
+
+    :param cluster_ids: Sorted cluster ids from group_spikes_by_cluster
+    :param offsets: Offsets from group_spikes_by_cluster
+    :param unit: Cluster id to get the slice of, clusters with no spikes give an empty slice
+    :return: slice
+    """
+    pos = np.searchsorted(cluster_ids, unit)
+    if pos >= len(cluster_ids) or cluster_ids[pos] != unit:
+        return slice(0, 0)
+    return slice(offsets[pos], offsets[pos + 1])
+
+
+def load_cluster_index(path: str, clusters_filename: str = 'spike_clusters.npy',
+                       index_filename: str = 'cluster_index.npz') -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Load the cluster to spike index of a Kilosort output folder, see group_spikes_by_cluster
+    The index is created once and saved next to the Kilosort outputs, it is recreated if the spike clusters file changed
+
+    :param path: Path to the Kilosort output folder
+    :param clusters_filename: Name of the spike clusters file, defaults to spike_clusters.npy
+    :param index_filename: Name of the index file, defaults to cluster_index.npz
+
+    :return: (cluster_ids, order, offsets) the spike indexes of cluster_ids[i] are order[offsets[i]:offsets[i + 1]]
+    """
+    clusters_fn = os.path.join(path, clusters_filename)
+    index_fn = os.path.join(path, index_filename)
+    stat = os.stat(clusters_fn)
+    source_info = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    if os.path.exists(index_fn):
+        with np.load(index_fn) as index:
+            if np.array_equal(index['source_info'], source_info):
+                return index['cluster_ids'], index['order'], index['offsets']
+        print(f"Cluster index '{index_fn}' is out of date, recreating..")
+
+    cluster_ids, order, offsets = group_spikes_by_cluster(np.load(clusters_fn, mmap_mode='r'))
+    try:
+        with open(index_fn, 'wb') as f:
+            np.savez(f, cluster_ids=cluster_ids, order=order, offsets=offsets, source_info=source_info)
+    except OSError as e:
+        warnings.warn(f"Unable to save cluster index '{index_fn}', it will be recreated on the next load! Error: '{str(e)}'")
+    return cluster_ids, order, offsets
+
+
+def mean_waveforms_from_continuous(continuous_dat_filename: str, spike_samples: np.ndarray, spike_clusters: np.ndarray,
+                                   num_channels: int = 384, samples_before: int = 41, samples_after: int = 41,
+                                   max_spikes: int = 500, seed: Optional[int] = 0,
+                                   batch_size: int = 1000) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Extract the mean waveform of every unit from the raw continuous.dat, around a capped random sample of its spikes
+    The sampled spikes of all units are read together in time order, so the file is scanned once sequentially
+
+    :param continuous_dat_filename: Path to the int16 continuous.dat file
+    :param spike_samples: Sample index of each spike in the continuous.dat, e.g. spike_times.npy
+    :param spike_clusters: Cluster id of each spike
+    :param num_channels: Number of channels in the file, defaults to 384
+    :param samples_before: Number of samples before the spike in the waveform
+    :param samples_after: Number of samples after the spike in the waveform
+    :param max_spikes: Max number of spikes per unit to average
+    :param seed: Seed for sampling the spikes
+    :param batch_size: Number of spike waveforms to read into memory at a time
+    :return: (cluster_ids, mean_waveforms, spike_counts) mean_waveforms is (units, time, channels) in raw int16 units,
+        spike_counts is how many spikes were averaged for each unit
+    """
+    data = np.memmap(continuous_dat_filename, dtype=np.int16, mode='r').reshape(-1, num_channels)
+    spike_samples = np.asarray(spike_samples).flatten().astype(np.int64)
+    cluster_ids, order, offsets = group_spikes_by_cluster(spike_clusters)
+    rng = np.random.default_rng(seed)
+
+    # Capped, seeded sample of each unit's spikes, skipping spikes too close to the ends of the file
+    sampled_spikes = [np.zeros(0, dtype=np.int64)]  # Empty entries so there is something to concatenate without units
+    sampled_units = [np.zeros(0, dtype=np.int64)]
+    for unit_row in range(len(cluster_ids)):
+        unit_samples = spike_samples[order[offsets[unit_row]:offsets[unit_row + 1]]]
+        unit_samples = unit_samples[(unit_samples >= samples_before) & (unit_samples + samples_after < data.shape[0])]
+        if len(unit_samples) > max_spikes:
+            unit_samples = rng.choice(unit_samples, max_spikes, replace=False)
+        sampled_spikes.append(unit_samples)
+        sampled_units.append(np.full(len(unit_samples), unit_row))
+    sampled_spikes = np.concatenate(sampled_spikes)
+    sampled_units = np.concatenate(sampled_units)
+
+    time_order = np.argsort(sampled_spikes, kind='stable')
+    sampled_spikes = sampled_spikes[time_order]
+    sampled_units = sampled_units[time_order]
+
+    window = np.arange(-samples_before, samples_after)
+    sums = np.zeros((len(cluster_ids), len(window), num_channels), dtype=np.float64)
+    for start in range(0, len(sampled_spikes), batch_size):
+        batch_spikes = sampled_spikes[start:start + batch_size]
+        batch_units = sampled_units[start:start + batch_size]
+        waveforms = data[batch_spikes[:, None] + window[None, :]]  # Increasing sample idxs, read in file order
+
+        # Sum the waveforms of each unit in the batch
+        unit_order = np.argsort(batch_units, kind='stable')
+        batch_units = batch_units[unit_order]
+        unit_starts = np.concatenate([[0], np.where(np.diff(batch_units) != 0)[0] + 1])
+        sums[batch_units[unit_starts]] += np.add.reduceat(waveforms[unit_order].astype(np.float64), unit_starts, axis=0)
+
+    spike_counts = np.bincount(sampled_units, minlength=len(cluster_ids))
+    with np.errstate(invalid='ignore'):
+        mean_waveforms = sums / spike_counts[:, None, None]  # NaN for units without any usable spikes
+    return cluster_ids, mean_waveforms.astype(np.float32), spike_counts
 
 
 def load_phy_template(path: str, site_positions: Optional[np.ndarray] = None, samplingrate: float = 30000.) -> dict:
@@ -64,7 +738,6 @@ def load_phy_template(path: str, site_positions: Optional[np.ndarray] = None, sa
         fps.append(myfp)
         return myfp
     try:
-        clusters = np.load(open_fp('spike_clusters.npy'))
         spikes = np.load(open_fp('spike_times.npy'))
         spike_templates = np.load(open_fp('spike_templates.npy'))
         templates = np.load(open_fp('templates.npy'))
@@ -83,42 +756,44 @@ def load_phy_template(path: str, site_positions: Optional[np.ndarray] = None, sa
             else:
                 print('cant find cluster groups, either .tsv or .csv')
 
+        # Group the spikes by cluster once, each unit's spikes are then a slice of the sorted arrays
+        cluster_ids, order, offsets = load_cluster_index(path)
+        sorted_spikes = spikes.flatten()[order]
+        sorted_spike_templates = spike_templates.flatten()[order]
+
         units = {}
+        mean_templates = []
         for i in np.arange(1, np.shape(cluster_id)[0]):
             unit = int(cluster_id[i][0].split('\t')[0])
             units[str(unit)] = {}
+            unit_slice = cluster_spike_slice(cluster_ids, offsets, unit)
 
             # get the unit spike times
-            units[str(unit)]['samples'] = spikes[np.where(clusters == unit)].flatten()
-            units[str(unit)]['times'] = spikes[np.where(clusters == unit)] / samplingrate
-            units[str(unit)]['times'] = units[str(unit)]['times'].flatten()
+            units[str(unit)]['samples'] = sorted_spikes[unit_slice]
+            units[str(unit)]['times'] = sorted_spikes[unit_slice] / samplingrate
 
             # get the mean template used for this unit
-            all_templates = spike_templates[np.where(clusters == unit)].flatten()
+            all_templates = sorted_spike_templates[unit_slice]
             n_templates_to_subsample = 100
             random_subsample_of_templates = templates[
                 all_templates[np.array(np.random.rand(n_templates_to_subsample) * all_templates.shape[0]).astype(int)]]
             mean_template = np.mean(random_subsample_of_templates, axis=0)
             units[str(unit)]['template'] = mean_template
-
-            # take a weighted average of the site_positions, where the weights is the absolute value of the template for that channel
-            # this gets us the x and y positions of the unit on the probe.
-            # print(mean_template.T.shape)
-            weights = np.zeros(site_positions.shape)
-            for channel in range(mean_template.T.shape[0]):
-                weights[channel, :] = np.trapz(np.abs(mean_template.T[channel, :]))
-            weights = weights / np.max(weights)
-            low_values_indices = weights < 0.25  # Where values are low,
-            weights[low_values_indices] = 0  # make the weight 0
-            (xpos, ypos) = np.average(site_positions, axis=0, weights=weights)
-            units[str(unit)]['waveform_weights'] = weights
-            units[str(unit)]['xpos'] = xpos
-            units[str(unit)]['ypos'] = ypos  # - site_positions[-1][1]
+            mean_templates.append(mean_template)
             units[str(unit)]['label'] = cluster_id[i][0].split('\t')[1]
             units[str(unit)]['KSlabel'] = KSlabel[i][0].split('\t')[1]
             units[str(unit)]['KSamplitude'] = KSamplitude[i][0].split('\t')[1]
             units[str(unit)]['KScontamination'] = KScontamination[i][0].split('\t')[1]
 
+        # take a weighted average of the site_positions, where the weights is the absolute value of the template for that channel
+        # this gets us the x and y positions of the unit on the probe. Done for all units at once
+        if mean_templates:
+            features = template_features(np.stack(mean_templates), site_positions, samplingrate)
+            for idx, unit in enumerate(units.keys()):
+                units[unit]['waveform_weights'] = features['waveform_weights'][idx]
+                units[unit]['xpos'] = features['xpos'][idx]
+                units[unit]['ypos'] = features['ypos'][idx]  # - site_positions[-1][1]
+
         return units
     finally:
         for fp in fps:  # Close all file pointers
@@ -247,34 +922,38 @@ def load_unit_data(recording_path: str, probe_depth: int = 3840, site_positions:
             sampRate = 30000
         spike_times = np.ndarray.flatten(np.load(os.path.join(recording_path, 'spike_times.npy')))/sampRate
     else:
-        spike_times = np.ndarray.flatten(np.load(os.path.join(recording_path, spikes_filename)))
+        spike_times = np.load(os.path.join(recording_path, spikes_filename), mmap_mode='r').reshape(-1)
 
     cluster_info = pd.read_csv(os.path.join(recording_path, 'cluster_info.tsv'), '\t')
     if cluster_info.keys()[0] == 'cluster_id':
         cluster_info = cluster_info.rename(columns={'cluster_id': 'id'})
-    spike_clusters = np.ndarray.flatten(np.load(os.path.join(recording_path, 'spike_clusters.npy')))
-    spike_templates = np.load(open(os.path.join(recording_path,'spike_templates.npy'),'rb'))
+    cluster_ids, order, offsets = load_cluster_index(recording_path)
+    spike_templates = np.load(os.path.join(recording_path, 'spike_templates.npy'), mmap_mode='r')
     templates = np.load(open(os.path.join(recording_path,'templates.npy'),'rb'))
-    amplitudes = np.load(open(os.path.join(recording_path,'amplitudes.npy'),'rb'))
-    weights = np.zeros(site_positions.shape)
+    amplitudes = np.load(os.path.join(recording_path, 'amplitudes.npy'), mmap_mode='r')
 
-    # Generate Unit Times Table
-    for index, unitID in enumerate(cluster_info['id'].values):
-        # get mean template used for each unit
-        all_templates = spike_templates[np.where(spike_clusters==unitID)].flatten()
+    # Indexes of each unit's spikes, sorted so reads of the memory mapped arrays are in order
+    unit_spike_idxs = [order[cluster_spike_slice(cluster_ids, offsets, unitID)] for unitID in cluster_info['id'].values]
+
+    # get mean template used for each unit
+    mean_templates = []
+    for spike_idxs in unit_spike_idxs:
+        all_templates = spike_templates[spike_idxs].flatten()
         n_templates_to_subsample = 100
         random_subsample_of_templates = templates[all_templates[np.array(np.random.rand(n_templates_to_subsample)*all_templates.shape[0]).astype(int)]]
-        mean_template = np.mean(random_subsample_of_templates,axis=0)
-
-        # take a weighted average of the site_positions, where the weights is the absolute value of the template for
-        # that channel
-        # this gets us the x and y positions of the unit on the probe.
-        for channel in range(mean_template.T.shape[0]):
-            weights[channel,:]=np.trapz(np.abs(mean_template.T[channel,:]))
-        weights = weights/np.max(weights)
-        low_values_indices = weights < 0.25  # Where values are low,
-        weights[low_values_indices] = 0      # make the weight 0
-        (xpos,zpos)=np.average(site_positions, axis=0, weights=weights)
+        mean_templates.append(np.mean(random_subsample_of_templates,axis=0))
+
+    # take a weighted average of the site_positions, where the weights is the absolute value of the template for
+    # that channel
+    # this gets us the x and y positions of the unit on the probe. Done for all units at once
+    features = template_features(np.stack(mean_templates), site_positions)
+
+    # Generate Unit Times Table
+    for index, unitID in enumerate(cluster_info['id'].values):
+        mean_template = mean_templates[index]
+        weights = features['waveform_weights'][index]
+        xpos = features['xpos'][index]
+        zpos = features['ypos'][index]
 
         unit_times.append({'probe':probe_name,
                            'unit_id': unitID,
@@ -289,8 +968,8 @@ def load_unit_data(recording_path: str, probe_depth: int = 3840, site_positions:
                            'KScontamination': cluster_info.ContamPct[index],
                            'template': mean_template,
                            'waveform_weights': weights,
-                           'amplitudes': amplitudes[:,0][spike_clusters==unitID],
-                           'times': spike_times[spike_clusters == unitID],
+                           'amplitudes': amplitudes[unit_spike_idxs[index], 0],
+                           'times': spike_times[unit_spike_idxs[index]],
                             })
     if df:
         unit_data = pd.DataFrame(unit_times)
@@ -322,20 +1001,20 @@ def load_unit_data_from_phy(recording_path: str, chanmap: Optional[dict] = None,
     cluster_info = pd.read_csv(os.path.join(recording_path, 'cluster_info.tsv'), '\t')
     if cluster_info.keys()[0] == 'cluster_id':
         cluster_info = cluster_info.rename(columns={'cluster_id': 'id'})
-    spike_clusters = np.ndarray.flatten(np.load(os.path.join(recording_path, 'spike_clusters.npy')))
-    spike_templates = np.load(open(os.path.join(recording_path, 'spike_templates.npy'), 'rb'))
+    cluster_ids, order, offsets = load_cluster_index(recording_path)
+    spike_templates = np.load(os.path.join(recording_path, 'spike_templates.npy'), mmap_mode='r')
     templates = np.load(open(os.path.join(recording_path, 'templates.npy'), 'rb'))
-    spike_times = np.load(open(os.path.join(recording_path, 'spike_times.npy'), 'rb'))
+    spike_times = np.load(os.path.join(recording_path, 'spike_times.npy'), mmap_mode='r')
     timestamps = np.load(open(os.path.join(recording_path, 'timestamps.npy'), 'rb'))
-    spike_secs = timestamps[spike_times.flatten()]
 
     # Parse spike times for each unit. also get the template so we can use it for waveform shape clustering
     times = []
     mean_templates = []
     for unitID in cluster_info.id.values:
-        times.append(spike_secs[spike_clusters == unitID])
+        spike_idxs = order[cluster_spike_slice(cluster_ids, offsets, unitID)]
+        times.append(timestamps[spike_times[spike_idxs].flatten()])
 
-        all_templates = spike_templates[np.where(spike_clusters == unitID)].flatten()
+        all_templates = spike_templates[spike_idxs].flatten()
         if len(all_templates) > 100:
             n_templates_to_subsample = 100
         else:
@@ -362,12 +1041,18 @@ def load_unit_data_from_phy(recording_path: str, chanmap: Optional[dict] = None,
     return cluster_info
 
 
-def recreate_probe_timestamps_from_TTL(directory: str) -> None:
+def recreate_probe_timestamps_from_TTL(directory: str, num_channels: int = 384, samplingrate: float = 30000.,
+                                       chunk_size: int = 10_000_000) -> None:
     """
-    Recreate probe timestamps from a TTL feed. Will create files new_timestamps/'templates.npy' and
+    Recreate probe timestamps from a TTL feed. Will create files new_timestamps/'timestamps.npy' and
     new_timestamps/'sample_numbers.npy'
+    Timestamps between TTL pulses are linearly interpolated, before the first and after the last pulse they are
+    extrapolated at the sampling rate
 
     :param directory: str to the directory
+    :param num_channels: Number of channels in continuous.dat, used to get the sample count from the file size
+    :param samplingrate: Rate at which the Neuropixels probe sampled the data, defaults to 30kHz
+    :param chunk_size: Number of samples to compute and write at a time
     :returns: None, will create files on FS
     """
 
@@ -388,61 +1073,74 @@ def recreate_probe_timestamps_from_TTL(directory: str) -> None:
         os.path.join(glob.glob(os.path.join(recording_base, 'events') + '/*Probe' + probe + '*AP*')[0], 'TTL',
                      'timestamps.npy'))[::2]
 
-    cont_raw = np.memmap(os.path.join(directory, 'continuous.dat'), dtype=np.int16)
-    cont_samples = np.arange(cont_start_sample, cont_start_sample + (int(cont_raw.shape[0] / 384)))
-    cont_timestamps = np.zeros(int(cont_raw.shape[0] / 384))
-
-    for i, sample in enumerate(TTL_samples):
-        ind = sample - cont_start_sample
-        cont_samples[ind] = sample
-        cont_timestamps[ind] = TTL_timestamps[i]
-        if i == 0:
-            cont_timestamps[:ind] = np.linspace(
-                TTL_timestamps[i] - (1 / 30000. * len(cont_timestamps[:ind - 1])) + 1 / 30000., TTL_timestamps[i],
-                len(cont_timestamps[:ind]))
-            prev_ind = ind
-        else:
-            cont_timestamps[prev_ind:ind] = np.linspace(cont_timestamps[prev_ind] + 1 / 30000., TTL_timestamps[i],
-                                                        len(cont_timestamps[prev_ind:ind]))
-            prev_ind = ind
-    cont_timestamps[ind:] = np.linspace(TTL_timestamps[i] + 1 / 30000.,
-                                        TTL_timestamps[i] + len(cont_timestamps[ind:]) * 1 / 30000.,
-                                        len(cont_timestamps[ind:]))
+    # continuous.dat is int16 samples interleaved by channel
+    num_samples = os.path.getsize(os.path.join(directory, 'continuous.dat')) // (np.dtype(np.int16).itemsize * num_channels)
 
     if not os.path.exists(os.path.join(directory, 'new_timestamps')):
         os.mkdir(os.path.join(directory, 'new_timestamps'))
-    np.save(open(os.path.join(directory, 'new_timestamps', 'sample_numbers.npy'), 'wb'), cont_samples.astype(np.int64))
-    np.save(open(os.path.join(directory, 'new_timestamps', 'timestamps.npy'), 'wb'), cont_timestamps.astype(np.float64))
+    cont_samples = np.lib.format.open_memmap(os.path.join(directory, 'new_timestamps', 'sample_numbers.npy'),
+                                             mode='w+', dtype=np.int64, shape=(num_samples,))
+    cont_timestamps = np.lib.format.open_memmap(os.path.join(directory, 'new_timestamps', 'timestamps.npy'),
+                                                mode='w+', dtype=np.float64, shape=(num_samples,))
+
+    for start in range(0, num_samples, chunk_size):
+        samples = np.arange(cont_start_sample + start, cont_start_sample + min(start + chunk_size, num_samples), dtype=np.int64)
+        timestamps = np.interp(samples, TTL_samples, TTL_timestamps)
+
+        before = samples < TTL_samples[0]
+        timestamps[before] = TTL_timestamps[0] - (TTL_samples[0] - samples[before]) / samplingrate
+        after = samples > TTL_samples[-1]
+        timestamps[after] = TTL_timestamps[-1] + (samples[after] - TTL_samples[-1]) / samplingrate
+
+        cont_samples[start:start + len(samples)] = samples
+        cont_timestamps[start:start + len(samples)] = timestamps
+
+    cont_samples.flush()
+    cont_timestamps.flush()
+    del cont_samples
+    del cont_timestamps
 
 
 def make_spike_secs(probe_folder):
     """
     Make spike_secs.npy, a file containing spike times along seconds
+    Skipped if spike_secs.npy is newer than spike_times.npy and timestamps.npy
 
     :param probe_folder: string path to the probe folder
 
     :return: None, will save file in directory
     """
 
-    c = np.load(os.path.join(probe_folder,'spike_times.npy'))
-    try:
-        a = np.load(os.path.join(probe_folder,'timestamps.npy'))
-    except:
+    spike_times_fn = os.path.join(probe_folder, 'spike_times.npy')
+    spike_secs_fn = os.path.join(probe_folder, 'spike_secs.npy')
+    timestamps_fn = None
+    for candidate in [os.path.join(probe_folder, 'timestamps.npy'), os.path.join(probe_folder, 'new_timestamps', 'timestamps.npy')]:
+        if os.path.exists(candidate):
+            timestamps_fn = candidate
+            break
+
+    if timestamps_fn is not None and os.path.exists(spike_secs_fn):
+        newest_input = max(os.path.getmtime(spike_times_fn), os.path.getmtime(timestamps_fn))
+        if os.path.getmtime(spike_secs_fn) > newest_input:
+            print(f'spike_secs.npy is up to date for {probe_folder}, skipping')
+            return
+
+    if timestamps_fn is None:
         try:
-            a = np.load(os.path.join(probe_folder, 'new_timestamps', 'timestamps.npy'))
-        except:
-            try:
-                print('could not find timestamps.npy, trying to recreate from the sync TTLs for '+probe_folder)
-                recreate_probe_timestamps_from_TTL(probe_folder)
-                a = np.load(os.path.join(probe_folder,'new_timestamps','timestamps.npy'))
-            except Exception as e:
-                print('could not find timestamps.npy')
-                raise e
+            print('could not find timestamps.npy, trying to recreate from the sync TTLs for '+probe_folder)
+            recreate_probe_timestamps_from_TTL(probe_folder)
+            timestamps_fn = os.path.join(probe_folder, 'new_timestamps', 'timestamps.npy')
+        except Exception as e:
+            print('could not find timestamps.npy')
+            raise e
+
+    c = np.load(spike_times_fn, mmap_mode='r')
+    a = np.load(timestamps_fn, mmap_mode='r')
 
     try:
         spike_secs = a[c.flatten()[np.where(c.flatten()<a.shape[0])]]
         print('shape of spike times annd timestamps not compatible, check above and investigate.')
-        np.save(open(os.path.join(probe_folder, 'spike_secs.npy'), 'wb'), spike_secs)
+        np.save(open(spike_secs_fn, 'wb'), spike_secs)
     except Exception as e:
         print("Error making spike_secs.npy!")
         print(np.shape(a))
@@ -451,22 +1149,38 @@ def make_spike_secs(probe_folder):
         raise e
 
 
+def _load_probe_unit_data(folder, probe_name, probe_depth, spikes_filename, make_secs):
+    # Load the unit data of a single probe, run in a worker process by multi_load_unit_data
+    if make_secs:
+        make_spike_secs(folder)
+    return load_unit_data(folder, probe_name=probe_name, probe_depth=probe_depth, spikes_filename=spikes_filename,
+                          aligned=True, df=True)
+
+
 def multi_load_unit_data(recording_folder, probe_names=['A', 'B', 'C', 'D'], probe_depths=[3840, 3840, 3840, 3840],
-                         spikes_filename='spike_secs.npy', aligned=True):
+                         spikes_filename='spike_secs.npy', aligned=True, workers=1):
     """
     Load multiple units
+
+    :param workers: Number of processes to load the probes with, None for number of cpus, defaults to 1 (no processes)
     """
 
     folder_paths = glob.glob(os.path.join(recording_folder, '*imec*'))
+    make_secs = False
     if len(folder_paths) > 0:
         spikes_filename = 'spike_secs.npy'
     else:
         folder_paths = glob.glob(os.path.join(recording_folder, '*AP*'))
         if len(folder_paths) > 0:
-            for probe_folder in folder_paths: make_spike_secs(probe_folder)
+            make_secs = True
         else:
             print('did not find any recordings in ' + recording_folder + '')
             return
-    return pd.concat([load_unit_data(folder, probe_name=probe_names[i], probe_depth=probe_depths[i],
-                                     spikes_filename=spikes_filename, aligned=True, df=True) for i, folder in
-                      enumerate(folder_paths)], ignore_index=True)
+
+    args = [(folder, probe_names[i], probe_depths[i], spikes_filename, make_secs) for i, folder in enumerate(folder_paths)]
+    if workers == 1:
+        probe_dfs = [_load_probe_unit_data(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            probe_dfs = list(pool.map(_load_probe_unit_data, *zip(*args)))
+    return pd.concat(probe_dfs, ignore_index=True)
@@ -107,15 +107,17 @@ def nwb_write(nwb_obj: NWBFile, filename: str, verify: bool):
             # Want to load file to check that it didn't corrupt
             tio = NWBHDF5IO(filename)
             try:
-                test_nwb = tio.read()
-                # Also note that your data can just 'be missing' because NWB decided not to write it 'for some reason'
-            except Exception as e:
-                warnings.warn(f"File is corrupted! NWB lets you write data that it won't read correctly, check your input data!")
-                raise e
+                try:
+                    test_nwb = tio.read()
+                    # Also note that your data can just 'be missing' because NWB decided not to write it 'for some reason'
+                except Exception as e:
+                    warnings.warn(f"File is corrupted! NWB lets you write data that it won't read correctly, check your input data!")
+                    raise e
+
+                # Compare while the file is still open, tables like units are read lazily
+                compare_nwbfiles(nwb_obj, test_nwb, "InMemoryNWB", "WrittenFileNWB")
             finally:
                 tio.close()
-
-            compare_nwbfiles(nwb_obj, test_nwb, "InMemoryNWB", "WrittenFileNWB")
     finally:
         io.close()
 
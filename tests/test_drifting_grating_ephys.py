@@ -0,0 +1,65 @@
+import os
+import tempfile
+
+import numpy as np
+
+from gen_nwb import nwb_gen
+from simply_nwb.pipeline.enrichments.saccades.drifting_grating.ephys import DriftingGratingEPhysEnrichment
+from simply_nwb.pipeline.enrichments.saccades.drifting_grating.multi_ephys import DriftingGratingMultiEPhysEnrichment
+from simply_nwb.pipeline.enrichments.saccades.drifting_grating.labjack import DriftingGratingLabjackEnrichment
+
+
+def _labjack_nwb(transition_storage):
+    # NWB with the labjack channels saved like DriftingGratingLabjackEnrichment does, dense or as transitions
+    rng = np.random.default_rng(0)
+    num_samples = 2000
+    dats = {"Time": np.arange(num_samples) / 2000.}
+    for channel in ["v0", "v1", "v2", "v3"]:
+        dats[channel] = rng.normal(size=num_samples)
+    for channel in DriftingGratingLabjackEnrichment.DIGITAL_CHANNELS:
+        dats[channel] = np.repeat(rng.integers(0, 2, num_samples // 100), 100).astype(float)
+
+    labjack = DriftingGratingLabjackEnrichment(["driftingGratingMetadata-0.txt"], ["labjack.dat"], transition_storage=transition_storage)
+    labjack._dats = dats
+    nwb = nwb_gen()
+    labjack._save_labjack_channels(nwb)
+    return nwb, dats
+
+
+def test_ephys_validate_labjack_storage():
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "empty.npy")
+        np.save(filename, np.zeros(10))
+
+        for transition_storage in [False, True]:
+            nwb, dats = _labjack_nwb(transition_storage)
+            stored = list(nwb.processing["Enrichment.DriftingGratingLabjack"].containers.keys())
+            assert ("y0_transitions" in stored) == transition_storage
+
+            ephys = DriftingGratingEPhysEnrichment(filename, filename, filename)
+            ephys.validate(nwb)  # Must not require keys of the other storage mode
+            assert np.allclose(ephys._get_req_val("labjack_time", nwb), dats["Time"])
+            assert np.array_equal(ephys._get_req_val("labjack_barcode", nwb), dats["y0"])
+            DriftingGratingMultiEPhysEnrichment({"imec0": (filename, filename, filename)}).validate(nwb)
+    print("Ephys labjack requirements test passed")
+
+
+def test_ephys_saved_keys():
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, "empty.npy")
+        np.save(filename, np.zeros(10))
+
+        binned = DriftingGratingEPhysEnrichment(filename, filename, filename).saved_keys()
+        unbinned = DriftingGratingEPhysEnrichment(filename, filename, filename, firing_rate_bin_size=None).saved_keys()
+        assert "firing_rate_bin_info" in binned
+        assert not any(k.startswith("firing_rate_") for k in unbinned)
+        # Static keys are the ones that are always saved
+        assert DriftingGratingEPhysEnrichment.saved_keys() == unbinned
+        descs = DriftingGratingEPhysEnrichment.descriptions()
+        assert all(k in descs for k in binned)
+    print("Ephys saved keys test passed")
+
+
+if __name__ == "__main__":
+    test_ephys_validate_labjack_storage()
+    test_ephys_saved_keys()
@@ -0,0 +1,152 @@
+import os
+import tempfile
+
+import numpy as np
+from scipy.signal import sosfiltfilt
+
+from gen_nwb import nwb_gen
+from simply_nwb import SimpleNWB
+from simply_nwb.pipeline.util.spikes import units_table_from_spikes
+from simply_nwb.transforms.neuropixels import ContinuousDatChunkIterator, ContinuousDatPreprocessor, LFPChunkIterator, mean_waveforms_from_continuous
+
+
+def _fake_continuous_dat(folder, num_samples=60000, num_channels=16):
+    rng = np.random.default_rng(0)
+    raw = (rng.normal(size=(num_samples, num_channels)) * 50 + rng.normal(size=(num_samples, 1)) * 20).astype(np.int16)
+    filename = os.path.join(folder, "continuous.dat")
+    raw.tofile(filename)
+    return filename, raw
+
+
+def test_continuous_chunks():
+    with tempfile.TemporaryDirectory() as folder:
+        filename, raw = _fake_continuous_dat(folder)
+        num_channels = raw.shape[1]
+
+        # Default buffers span every channel so each is one contiguous read, and stay under buffer_gb
+        iterator = ContinuousDatChunkIterator(filename, num_channels=num_channels, chunk_mb=0.01, buffer_gb=0.0001)
+        assert iterator.chunk_shape[1] == num_channels and iterator.buffer_shape[1] == num_channels
+        assert iterator.buffer_shape[0] * num_channels * 2 <= 0.0001 * 1e9
+
+        data = np.empty(iterator.maxshape, dtype=np.int16)
+        for chunk in iterator:
+            data[chunk.selection] = chunk.data
+        assert np.array_equal(data, raw)
+    print("Continuous chunks test passed")
+
+
+def test_preprocessor_to_dat():
+    with tempfile.TemporaryDirectory() as folder:
+        filename, raw = _fake_continuous_dat(folder)
+        num_channels = raw.shape[1]
+        preprocessor = ContinuousDatPreprocessor(filename, num_channels=num_channels, reference="median", workers=4)
+
+        output_filename = os.path.join(folder, "preprocessed.dat")
+        preprocessor.to_dat(output_filename, block_samples=7000)
+        output = np.fromfile(output_filename, dtype=np.int16).reshape(-1, num_channels)
+
+        # Reference and filter the whole recording at once
+        expected = raw.astype(np.float32)
+        expected -= np.median(expected, axis=1, keepdims=True)
+        expected = sosfiltfilt(preprocessor.sos, expected, axis=0)
+        expected = np.clip(np.rint(expected), -32768, 32767).astype(np.int16)
+
+        # Blocks only differ from the whole recording by rounding
+        assert output.shape == raw.shape
+        assert np.abs(output.astype(np.int32) - expected).max() <= 1
+
+        # Iterator buffers span every channel so each block is referenced once, sized from the raw float64 samples
+        iterator = preprocessor.iterator(chunk_mb=0.01, buffer_gb=0.001)
+        assert iterator.buffer_shape[1] == num_channels
+        assert iterator.buffer_shape[0] * num_channels * 8 <= 0.001 * 1e9
+        written = np.empty(iterator.maxshape, dtype=np.int16)
+        for chunk in iterator:
+            written[chunk.selection] = chunk.data
+        assert np.abs(written.astype(np.int32) - expected).max() <= 1
+    print("Preprocessor test passed")
+
+
+def test_lfp_chunks():
+    with tempfile.TemporaryDirectory() as folder:
+        filename, raw = _fake_continuous_dat(folder)
+        num_channels = raw.shape[1]
+        # Default buffers span every channel and bound the raw float64 samples behind each buffer
+        iterator = LFPChunkIterator(filename, num_channels=num_channels, chunk_mb=0.01, buffer_gb=0.001)
+        assert iterator.buffer_shape[1] == num_channels
+        assert iterator.buffer_shape[0] * iterator.factor * num_channels * 8 <= 0.001 * 1e9
+
+        # Channel subsets are filtered without referencing, so they match the same channels of the full output
+        subset = iterator.preprocessor.process_block(1000, 4000, slice(3, 7))
+        assert np.array_equal(subset, iterator.preprocessor.process_block(1000, 4000)[:, 3:7])
+
+        iterator = LFPChunkIterator(filename, num_channels=num_channels, chunk_shape=(500, num_channels), buffer_shape=(1500, num_channels))
+
+        lfp = np.empty(iterator.maxshape, dtype=np.int16)
+        for chunk in iterator:
+            lfp[chunk.selection] = chunk.data
+
+        # Filter the whole recording at once (kept as float32 like the preprocessor), then decimate
+        expected = sosfiltfilt(iterator.preprocessor.sos, raw.astype(np.float32), axis=0).astype(np.float32)[::iterator.factor]
+        expected = np.clip(np.rint(expected), -32768, 32767).astype(np.int16)
+        assert np.array_equal(lfp, expected)
+
+        # Site positions must match the channels when creating the probe's electrodes
+        try:
+            SimpleNWB.neuropixels_lfp_as_processing(nwb_gen(), filename, num_channels=num_channels)
+            assert False, "Mismatched site positions should raise"
+        except ValueError:
+            pass
+    print("LFP test passed")
+
+
+def test_mean_waveforms():
+    with tempfile.TemporaryDirectory() as folder:
+        filename, raw = _fake_continuous_dat(folder)
+        num_samples, num_channels = raw.shape
+        rng = np.random.default_rng(1)
+        spike_samples = np.sort(rng.integers(0, num_samples, 3000))[:, None]
+        spike_clusters = rng.integers(0, 6, 3000)
+        spike_clusters[spike_clusters == 2] = 13  # Non-contiguous unit ids
+
+        # No cap, so every spike (away from the ends of the file) is averaged, read in small batches
+        cluster_ids, mean_waveforms, spike_counts = mean_waveforms_from_continuous(
+            filename, spike_samples, spike_clusters, num_channels=num_channels, max_spikes=len(spike_clusters), batch_size=137
+        )
+        assert np.array_equal(cluster_ids, np.unique(spike_clusters))
+        assert mean_waveforms.shape == (len(cluster_ids), 82, num_channels)
+        for row, cluster_id in enumerate(cluster_ids):
+            samples = spike_samples[spike_clusters == cluster_id, 0]
+            samples = samples[(samples >= 41) & (samples + 41 < num_samples)]
+            expected = np.mean([raw[sample - 41:sample + 41] for sample in samples], axis=0)
+            assert spike_counts[row] == len(samples)
+            assert np.allclose(mean_waveforms[row], expected, atol=1e-4)
+
+        # Capped samples are reproducible with a seed
+        _, capped, capped_counts = mean_waveforms_from_continuous(filename, spike_samples, spike_clusters, num_channels=num_channels, max_spikes=50, seed=3)
+        _, capped_again, _ = mean_waveforms_from_continuous(filename, spike_samples, spike_clusters, num_channels=num_channels, max_spikes=50, seed=3)
+        assert np.all(capped_counts == 50)
+        assert np.array_equal(capped, capped_again)
+
+        # No spikes at all
+        cluster_ids, mean_waveforms, spike_counts = mean_waveforms_from_continuous(filename, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), num_channels=num_channels)
+        assert len(cluster_ids) == 0 and mean_waveforms.shape == (0, 82, num_channels) and len(spike_counts) == 0
+
+        # Stored in the units table in volts, in the order of the table's ids
+        nwb = nwb_gen()
+        nwb.units = units_table_from_spikes(spike_samples[:, 0] / 30000., spike_clusters)
+        SimpleNWB.neuropixels_add_mean_waveforms(nwb, filename, spike_samples, spike_clusters, num_channels=num_channels, max_spikes=len(spike_clusters))
+        assert np.allclose(nwb.units["waveform_mean"][:], mean_waveforms_from_continuous(filename, spike_samples, spike_clusters, num_channels=num_channels, max_spikes=len(spike_clusters))[1] * 0.195e-6)
+
+        # Units without spikes in the units table get NaN waveforms
+        nwb = nwb_gen()
+        nwb.units = units_table_from_spikes(spike_samples[:, 0] / 30000., spike_clusters)
+        SimpleNWB.neuropixels_add_mean_waveforms(nwb, filename, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), num_channels=num_channels)
+        assert np.all(np.isnan(nwb.units["waveform_mean"][:]))
+    print("Mean waveforms test passed")
+
+
+if __name__ == "__main__":
+    test_continuous_chunks()
+    test_preprocessor_to_dat()
+    test_lfp_chunks()
+    test_mean_waveforms()
@@ -0,0 +1,90 @@
+import matplotlib
+matplotlib.use("Agg")  # Headless, the GUIs are driven by scripted events
+
+import numpy as np
+from matplotlib import pylab as plt
+from matplotlib.backend_bases import KeyEvent, MouseEvent
+
+from simply_nwb.pipeline.util.saccade_gui.direction import SaccadeDirectionLabelingGUI
+from simply_nwb.pipeline.util.saccade_gui.epochs import SaccadeEpochLabelingGUI
+
+
+def _press_key(gui, key):
+    gui.fig.canvas.callbacks.process("key_press_event", KeyEvent("key_press_event", gui.fig.canvas, key))
+
+
+def _click_button(gui, button):
+    # Click in the center of the button's axes, like a user would
+    canvas = gui.fig.canvas
+    x, y = button.ax.transAxes.transform((0.5, 0.5))
+    for name in ["button_press_event", "button_release_event"]:
+        canvas.callbacks.process(name, MouseEvent(name, canvas, x, y, button=1))
+
+
+def _scripted_driver(steps):
+    # Run one scripted step each time the GUI hands control to the driver
+    steps = list(steps)
+
+    def driver(g):
+        if steps:
+            steps.pop(0)(g)
+    return driver
+
+
+def _waveforms(num_samples=4, num_features=20):
+    return np.random.default_rng(0).normal(size=(num_samples, num_features))
+
+
+def test_direction_gui():
+    gui = SaccadeDirectionLabelingGUI()
+    gui.inputSamples(_waveforms())
+    driver = _scripted_driver([
+        lambda g: _press_key(g, "up"),  # Unscored -> Noise
+        lambda g: _press_key(g, "enter"),  # Next sample
+        lambda g: _press_key(g, "up"),  # Unscored -> Noise
+        lambda g: _press_key(g, "up"),  # Noise -> Right
+        lambda g: _click_button(g, g.exitButton)
+    ])
+    assert gui.wait(timeout=10, interval=0.01, driver=driver)
+    assert not gui.isRunning()
+
+    X, y = gui.trainingData
+    assert np.array_equal(y.flatten(), [0, 1])
+    assert np.array_equal(X, _waveforms()[:2])
+
+    # Nothing closes the GUI, should give up once the timeout is reached
+    gui = SaccadeDirectionLabelingGUI()
+    gui.inputSamples(_waveforms())
+    assert not gui.wait(timeout=0.2, interval=0.01, driver=lambda g: None)
+    assert gui.isRunning()
+    plt.close(gui.fig)
+    print("Direction GUI test passed")
+
+
+def test_epoch_gui():
+    gui = SaccadeEpochLabelingGUI()
+    gui.inputSamples(_waveforms(), np.ones(4))
+    driver = _scripted_driver([
+        lambda g: _press_key(g, "shift+left"),  # Move the start back a sample
+        lambda g: _press_key(g, "down"),  # Toggle to the stop boundary
+        lambda g: _press_key(g, "shift+right"),  # Move the stop forward a sample
+        lambda g: _press_key(g, "shift+right"),
+        lambda g: _click_button(g, g.exitButton)
+    ])
+    assert gui.wait(timeout=10, interval=0.01, driver=driver)
+    assert not gui.isRunning()
+
+    X, y, z = gui.trainingData
+    assert np.allclose(y, [[-1, 2]])
+    assert np.array_equal(X, _waveforms()[:1])
+
+    gui = SaccadeEpochLabelingGUI()
+    gui.inputSamples(_waveforms(), np.ones(4))
+    assert not gui.wait(timeout=0.2, interval=0.01)
+    plt.close(gui.fig)
+    print("Epoch GUI test passed")
+
+
+if __name__ == "__main__":
+    test_direction_gui()
+    test_epoch_gui()
@@ -0,0 +1,49 @@
+import os
+import tempfile
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from pynwb import NWBHDF5IO
+
+from gen_nwb import nwb_gen
+from simply_nwb.pipeline import NWBSession
+from simply_nwb.pipeline.util.spikes import units_table_from_spikes
+
+
+def _fake_kilosort_spikes(folder, num_spikes=5000, num_units=7):
+    rng = np.random.default_rng(0)
+    spike_times = open_memmap(os.path.join(folder, "spike_times.npy"), mode="w+", dtype=np.uint64, shape=(num_spikes, 1))
+    spike_times[:, 0] = np.sort(rng.integers(0, 30000 * 60, num_spikes))
+    spike_times.flush()
+    spike_clusters = rng.integers(0, num_units, num_spikes).astype(np.int32)
+    spike_clusters[spike_clusters == 3] = 11  # Non-contiguous unit ids
+    return np.load(os.path.join(folder, "spike_times.npy"), mmap_mode="r"), spike_clusters
+
+
+def test_units_table_save():
+    def align(times):
+        return times / 30000.0 + 2.5
+
+    with tempfile.TemporaryDirectory() as folder:
+        spike_times, spike_clusters = _fake_kilosort_spikes(folder)
+
+        for chunk_size in [None, 333]:
+            nwb = nwb_gen()
+            nwb.units = units_table_from_spikes(spike_times, spike_clusters, description="Test units", transform=align, chunk_size=chunk_size)
+
+            # Save through the session, which verifies the written file (including the units) against the one in memory
+            filename = os.path.join(folder, f"units_{chunk_size}.nwb")
+            NWBSession(nwb).save(filename)
+
+            with NWBHDF5IO(filename) as io:
+                units = io.read().units
+                unit_ids = np.asarray(units.id[:])
+                assert np.array_equal(unit_ids, np.unique(spike_clusters))
+                for row, unit_id in enumerate(unit_ids):
+                    expected = align(spike_times[spike_clusters == unit_id, 0].astype(np.float64))
+                    assert np.allclose(units["spike_times"][row], expected)
+    print("Units table save test passed")
+
+
+if __name__ == "__main__":
+    test_units_table_save()